@@ -0,0 +1,284 @@
+import os
+import json
+import asyncio
+import logging
+import asyncpg
+import pandas as pd
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from instrumentation import metrics
+from upload_to_cockroachdb import (
+    VERSIONS_TABLE, build_create_table_query, build_versions_table_query, column_types, new_table_version,
+    prepare_dataframe, sanitize_value
+)
+
+
+# Rows written per transaction, kept well below CockroachDB's transaction size limits
+BATCH_SIZE = int(os.getenv('DB_BATCH_SIZE', '1000'))
+
+# Size of the connection pool, i.e. how many batches can be written at the same time
+POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '4'))
+
+# Attempts per batch when CockroachDB aborts its transaction with a serialization failure (SQLSTATE 40001)
+SERIALIZATION_RETRIES = int(os.getenv('DB_SERIALIZATION_RETRIES', '5'))
+
+# Load freshly created tables with COPY instead of upserts (Postgres/Supabase, or CockroachDB versions with binary COPY)
+USE_COPY = os.getenv('DB_USE_COPY', 'false').lower() == 'true'
+
+def to_int(value):
+    # Postgres rounds when it casts a number into an integer column
+    return int(round(value)) if isinstance(value, float) else int(value)
+
+def to_float(value):
+    return float(value)
+
+def to_text(value):
+    return value if isinstance(value, str) else str(value)
+
+def to_timestamp(value):
+    if isinstance(value, str):
+        value = pd.Timestamp(value)
+    return value.to_pydatetime() if isinstance(value, pd.Timestamp) else value
+
+# Python conversions asyncpg needs for each column type created by build_create_table_query
+CONVERTERS = {
+    'JSONB': to_text,
+    'INTEGER': to_int,
+    'FLOAT': to_float,
+    'TIMESTAMP': to_timestamp,
+    'TEXT': to_text
+}
+
+# information_schema.columns data types of existing tables -> the column types above
+DATA_TYPES = {
+    'jsonb': 'JSONB',
+    'smallint': 'INTEGER',
+    'integer': 'INTEGER',
+    'bigint': 'INTEGER',
+    'real': 'FLOAT',
+    'double precision': 'FLOAT',
+    'numeric': 'FLOAT',
+    'timestamp without time zone': 'TIMESTAMP',
+    'timestamp with time zone': 'TIMESTAMP',
+    'text': 'TEXT',
+    'character varying': 'TEXT'
+}
+
+async def create_pool(pool_size=POOL_SIZE):
+    return await asyncpg.create_pool(
+        host=os.getenv('COCKROACH_DB_HOST'),
+        database=os.getenv('COCKROACH_DB_DATABASE'),
+        user=os.getenv('COCKROACH_DB_USER'),
+        password=os.getenv('COCKROACH_DB_PASSWORD'),
+        port=int(os.getenv('COCKROACH_DB_PORT', '26257')),
+        min_size=1,
+        max_size=pool_size
+    )
+
+def log_batch_retry(retry_state):
+    metrics.increment('batch_retries')
+    logging.warning(f"Retrying batch after a serialization failure (attempt {retry_state.attempt_number}): {retry_state.outcome.exception()}")
+
+def build_records(dataframe, srid, drawing_info, table_types=None):
+    """Turns a downloaded layer into a column list and a list of record tuples ready for asyncpg.
+
+    Values are converted to the types of the existing table's columns (table_types, column name
+    -> CONVERTERS key), since asyncpg doesn't cast parameters the way Postgres does for text
+    queries. Rows with a value that can't be converted are skipped.
+    """
+    dataframe = prepare_dataframe(dataframe)
+    table_types = table_types or {}
+    with metrics.span('build_records'):
+        converters = [
+            CONVERTERS[table_types.get(column_name) or column_type]
+            for column_name, column_type in column_types(dataframe)
+        ]
+        drawing_info_json = json.dumps(dict(drawing_info))
+        records = []
+        for row in dataframe.itertuples(index=False, name=None):
+            record = []
+            try:
+                for converter, value in zip(converters, row):
+                    value = sanitize_value(value)
+                    record.append(None if value is None else converter(value))
+            except (TypeError, ValueError) as e:
+                metrics.increment('row_errors')
+                logging.debug(f"Skipping row that doesn't fit the table's column types: {e}")
+                continue
+            record.append(srid)
+            record.append(drawing_info_json)
+            records.append(tuple(record))
+    columns = list(dataframe.columns) + ['srid', 'drawing_info']
+    return columns, records
+
+def build_upsert_query(table_name, columns, conflict_column):
+    column_list = ', '.join([f'"{col}"' for col in columns])
+    values = ', '.join([f'${index}' for index in range(1, len(columns) + 1)])
+    if conflict_column is None:
+        return f"INSERT INTO {table_name} ({column_list}) VALUES ({values})"
+    update_set = ', '.join([f'"{col}" = EXCLUDED."{col}"' for col in columns if col != 'id'])
+    return f"""
+    INSERT INTO {table_name} ({column_list})
+    VALUES ({values})
+    ON CONFLICT ("{conflict_column}") DO UPDATE SET {update_set}
+    """
+
+class AsyncDatabaseWriter:
+    """Writes downloaded layers through an asyncpg connection pool.
+
+    Rows are upserted in batches of BATCH_SIZE, one transaction per batch, and a batch aborted by a
+    serialization failure is tried up to SERIALIZATION_RETRIES times in all. The statement is
+    prepared through each pooled connection's statement cache, so it is parsed once per table
+    and column set on every connection rather than once per batch.
+
+    Every write first gives the table a new version in VERSIONS_TABLE (also for writes that then
+    fail, since some of their batches may have been committed).
+
+    With a schema the tables are created there instead of the search path. A bulk load into a
+    fresh shadow schema passes deferred_unique=True: tables are then created without their
+    UNIQUE constraint and filled with plain inserts, and build_unique_indexes() adds the
+    constraints once everything is loaded.
+    """
+
+    def __init__(self, pool, batch_size=BATCH_SIZE, use_copy=USE_COPY, schema=None, deferred_unique=False):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.use_copy = use_copy
+        self.schema = schema
+        self.deferred_unique = deferred_unique
+        self.table_locks = {}
+        self.known_tables = set()
+        self.key_columns = {}  # table name -> column the UNIQUE constraint is on
+        self.table_types = {}  # table name -> {column name: CONVERTERS key} of the table in the database
+        self.versions_lock = asyncio.Lock()
+        self.versions_table_ready = False
+
+    @classmethod
+    async def connect(cls, pool_size=POOL_SIZE, **kwargs):
+        return cls(await create_pool(pool_size), **kwargs)
+
+    async def close(self):
+        await self.pool.close()
+
+    def qualified_name(self, table_name):
+        return f'"{self.schema}".{table_name}' if self.schema else table_name
+
+    async def ensure_table(self, table_name, dataframe):
+        """Creates the table if needed and returns True if it was created by this writer (and is empty)."""
+        lock = self.table_locks.setdefault(table_name, asyncio.Lock())
+        async with lock:
+            if table_name in self.known_tables:
+                return False
+            exists = await self.pool.fetchval(
+                "SELECT EXISTS (SELECT 1 FROM information_schema.tables "
+                "WHERE table_name = $1 AND table_schema = COALESCE($2, current_schema()))",
+                table_name, self.schema
+            )
+            if not exists:
+                logging.info(f"Creating table {self.qualified_name(table_name)}")
+                await self.pool.execute(build_create_table_query(
+                    self.qualified_name(table_name), dataframe, unique=not self.deferred_unique
+                ))
+            rows = await self.pool.fetch(
+                "SELECT column_name, data_type FROM information_schema.columns "
+                "WHERE table_name = $1 AND table_schema = COALESCE($2, current_schema())",
+                table_name, self.schema
+            )
+            self.table_types[table_name] = {
+                row['column_name']: DATA_TYPES[row['data_type']] for row in rows if row['data_type'] in DATA_TYPES
+            }
+            self.known_tables.add(table_name)
+            self.key_columns[table_name] = dataframe.columns[0]
+            return not exists
+
+    async def mark_changed(self, table_name):
+        """Gives the table a new version in VERSIONS_TABLE before it is written, so the tile export re-reads it."""
+        async with self.versions_lock:
+            if not self.versions_table_ready:
+                await self.pool.execute(build_versions_table_query(self.qualified_name(VERSIONS_TABLE)))
+                self.versions_table_ready = True
+        await self.pool.execute(
+            f"INSERT INTO {self.qualified_name(VERSIONS_TABLE)} (table_name, version) VALUES ($1, $2) "
+            "ON CONFLICT (table_name) DO UPDATE SET version = EXCLUDED.version",
+            table_name, new_table_version()
+        )
+
+    # Concurrent transactions can be aborted by CockroachDB with 40001, which clients are expected to retry
+    @retry(
+        retry=retry_if_exception_type(asyncpg.SerializationError),
+        stop=stop_after_attempt(SERIALIZATION_RETRIES),
+        wait=wait_random_exponential(multiplier=0.1, max=5),
+        before_sleep=log_batch_retry,
+        reraise=True
+    )
+    async def write_batch(self, table_name, query, columns, batch, copy):
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                if copy:
+                    await connection.copy_records_to_table(
+                        table_name, records=batch, columns=columns, schema_name=self.schema
+                    )
+                else:
+                    await connection.executemany(query, batch)
+        metrics.increment('rows_written', len(batch))
+
+    async def write(self, table_name, dataframe, srid, drawing_info):
+        """Writes every batch of the layer, then raises if any of them failed."""
+        created = await self.ensure_table(table_name, dataframe)
+        await self.mark_changed(table_name)
+        conflict_column = dataframe.columns[0]
+        loop = asyncio.get_running_loop()
+        columns, records = await loop.run_in_executor(
+            None, build_records, dataframe, srid, drawing_info, self.table_types.get(table_name)
+        )
+
+        copy = self.use_copy and created
+        if self.deferred_unique:
+            conflict_column = None
+        query = build_upsert_query(self.qualified_name(table_name), columns, conflict_column)
+        batches = [records[i:i + self.batch_size] for i in range(0, len(records), self.batch_size)]
+        results = await asyncio.gather(
+            *(self.write_batch(table_name, query, columns, batch, copy) for batch in batches),
+            return_exceptions=True
+        )
+        errors = [result for result in results if isinstance(result, Exception)]
+        for error in errors:
+            metrics.increment('batch_errors')
+            logging.error(f"Error writing batch to {table_name}: {error}")
+        if errors:
+            raise RuntimeError(f"{len(errors)} of {len(batches)} batches could not be written to {table_name}")
+
+    async def remove_duplicate_keys(self, table_name, key_column):
+        """Keeps only the last written row of each key, like the ON CONFLICT upserts of an in-place load.
+
+        Layers whose titles sanitize to the same table name share a table, so their keys can collide.
+        """
+        status = await self.pool.execute(
+            f'DELETE FROM {self.qualified_name(table_name)} WHERE id IN ('
+            f'SELECT id FROM (SELECT id, row_number() OVER (PARTITION BY "{key_column}" ORDER BY id DESC) AS position '
+            f'FROM {self.qualified_name(table_name)} WHERE "{key_column}" IS NOT NULL) AS ranked WHERE position > 1)'
+        )
+        removed = int(status.split()[-1])
+        if removed:
+            metrics.increment('duplicate_rows_removed', removed)
+            logging.warning(f"Removed {removed} rows with duplicate {key_column} from {self.qualified_name(table_name)}")
+
+    async def build_unique_indexes(self):
+        """Adds the UNIQUE constraints deferred during a bulk load, one table at a time.
+
+        Returns False if any index could not be built, in which case the load must not go live.
+        """
+        succeeded = True
+        for table_name in sorted(self.known_tables):
+            key_column = self.key_columns[table_name]
+            try:
+                with metrics.span('build_index'):
+                    await self.remove_duplicate_keys(table_name, key_column)
+                    await self.pool.execute(
+                        f'CREATE UNIQUE INDEX IF NOT EXISTS {table_name[:58]}_key '
+                        f'ON {self.qualified_name(table_name)} ("{key_column}")'
+                    )
+            except asyncpg.PostgresError as e:
+                succeeded = False
+                metrics.increment('index_errors')
+                logging.error(f"Error building unique index on {self.qualified_name(table_name)}: {e}")
+        return succeeded
@@ -0,0 +1,256 @@
+"""Local stand-in for the ArcGIS REST servers crawled by the pipeline.
+
+Replays the folder/service/layer structure recorded in all_server_responses.json and serves
+synthetic, paginated feature queries as JSON or PBF, with configurable latency, error rate and scale.
+
+    python benchmarks/mock_arcgis_server.py --port 8765 --latency 0.05 --scale 4
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import struct
+import sys
+from urllib.parse import urlparse
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mvt_encoder import WIRE_FIXED64, encode_bytes_field, encode_key, encode_packed_field, encode_varint_field, zigzag
+
+
+DEFAULT_METADATA_PATH = 'all_server_responses.json'
+
+# Centre of Los Angeles County, synthetic features are scattered around it
+LA_CENTER = (-118.2437, 34.0522)
+
+MAX_RECORD_COUNT = 1000
+
+# FeatureCollectionPBuffer enums used by the f=pbf responses
+PBF_GEOMETRY_TYPES = {'esriGeometryPoint': 0, 'esriGeometryMultipoint': 1, 'esriGeometryPolyline': 2}
+PBF_FIELD_TYPES = {'esriFieldTypeOID': 6, 'esriFieldTypeString': 4}
+
+# Quantization used when a pbf query doesn't send quantizationParameters
+DEFAULT_TOLERANCE = 1e-6
+
+def local_base_url(server_url, copy):
+    """Maps a recorded server URL to the path it is served under, e.g. /c0/maps.lacity.org/lahub/rest/services."""
+    parsed = urlparse(server_url)
+    return f"/c{copy}/{parsed.netloc}{parsed.path.rstrip('/')}"
+
+def esri_field(name, index):
+    if index == 0:
+        return {'name': name, 'type': 'esriFieldTypeOID', 'alias': name}
+    return {'name': name, 'type': 'esriFieldTypeString', 'alias': name, 'length': 255}
+
+def encode_double_field(field_number, value):
+    return encode_key(field_number, WIRE_FIXED64) + struct.pack('<d', value)
+
+def encode_pbf_value(value):
+    """esriPBuffer Value: uint_value for object ids, string_value for everything else."""
+    if isinstance(value, int):
+        return encode_varint_field(5, value)
+    return encode_bytes_field(1, str(value).encode('utf-8'))
+
+def encode_pbf_geometry(geometry, translate, tolerance):
+    """Quantizes a JSON geometry with an upper-left origin into zigzag deltas from its first vertex."""
+    if 'paths' in geometry:
+        parts = geometry['paths']
+    elif 'points' in geometry:
+        parts = [geometry['points']]
+    else:
+        parts = [[[geometry['x'], geometry['y']]]]
+    coords = []
+    previous_x = previous_y = 0
+    for part in parts:
+        for x, y in part:
+            quantized_x = round((x - translate[0]) / tolerance)
+            quantized_y = round((translate[1] - y) / tolerance)
+            coords.append(zigzag(quantized_x - previous_x))
+            coords.append(zigzag(quantized_y - previous_y))
+            previous_x, previous_y = quantized_x, quantized_y
+    # Points and multipoints carry no part lengths
+    message = encode_packed_field(2, [len(part) for part in parts]) if 'paths' in geometry else b''
+    return message + encode_packed_field(3, coords)
+
+def encode_feature_collection(result, params):
+    """Encodes a JSON query result as the FeatureCollectionPBuffer returned by f=pbf."""
+    quantization = json.loads(params.get('quantizationParameters') or '{}')
+    extent = quantization.get('extent') or {'xmin': LA_CENTER[0] - 0.5, 'ymax': LA_CENTER[1] + 0.5}
+    tolerance = quantization.get('tolerance') or DEFAULT_TOLERANCE
+    translate = (extent['xmin'], extent['ymax'])
+
+    transform = (
+        encode_varint_field(1, 0)
+        + encode_bytes_field(2, encode_double_field(1, tolerance) + encode_double_field(2, tolerance))
+        + encode_bytes_field(3, encode_double_field(1, translate[0]) + encode_double_field(2, translate[1]))
+    )
+    message = encode_bytes_field(1, result['objectIdFieldName'].encode('utf-8'))
+    message += encode_varint_field(7, PBF_GEOMETRY_TYPES[result['geometryType']])
+    message += encode_varint_field(9, int(result['exceededTransferLimit']))
+    message += encode_bytes_field(12, transform)
+    for field in result['fields']:
+        message += encode_bytes_field(13, encode_bytes_field(1, field['name'].encode('utf-8')) + encode_varint_field(2, PBF_FIELD_TYPES[field['type']]))
+    for feature in result['features']:
+        attributes = b''.join(
+            encode_bytes_field(1, encode_pbf_value(feature['attributes'][field['name']])) for field in result['fields']
+        )
+        message += encode_bytes_field(15, attributes + encode_bytes_field(2, encode_pbf_geometry(feature['geometry'], translate, tolerance)))
+    return encode_bytes_field(1, b'3.0') + encode_bytes_field(2, encode_bytes_field(1, message))
+
+def layer_definition(layer, layer_id):
+    fields = layer.get('fields') or ['OBJECTID']
+    return {
+        'id': layer_id,
+        'name': layer['layer_name'],
+        'type': 'Feature Layer',
+        'description': layer.get('description', ''),
+        'geometryType': layer['geometry_type'],
+        'fields': [esri_field(name, index) for index, name in enumerate(fields)],
+        'objectIdField': fields[0],
+        'maxRecordCount': MAX_RECORD_COUNT,
+        'capabilities': 'Query',
+        'supportedQueryFormats': 'JSON, geoJSON, PBF',
+        'advancedQueryCapabilities': {'supportsPagination': True},
+        'extent': {
+            'xmin': LA_CENTER[0] - 0.5, 'ymin': LA_CENTER[1] - 0.5,
+            'xmax': LA_CENTER[0] + 0.5, 'ymax': LA_CENTER[1] + 0.5,
+            'spatialReference': {'wkid': 4326, 'latestWkid': 4326}
+        },
+        'drawingInfo': {'renderer': {'type': 'simple', 'symbol': None}}
+    }
+
+class MockArcGISServer:
+    def __init__(self, metadata, latency=0.0, jitter=0.0, error_rate=0.0, scale=1, features_per_layer=2000, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.features_per_layer = features_per_layer
+        self.random = random.Random(seed)
+        self.documents = {}  # request path -> JSON document
+        self.layers = {}  # layer path -> layer definition
+        self.server_urls = []
+        for copy in range(scale):
+            for server_url, server_results in metadata.items():
+                base = local_base_url(server_url, copy)
+                self.server_urls.append(base)
+                self.add_folder(base, '', {
+                    'services': server_results.get('services', []),
+                    'subfolders': server_results.get('folders', [])
+                })
+
+    def add_folder(self, base, folder_path, folder):
+        subfolder_names = []
+        for subfolder in folder.get('subfolders', []):
+            subfolder_names.append(subfolder['folder_name'])
+            subfolder_path = f"{folder_path}/{subfolder['folder_name']}" if folder_path else subfolder['folder_name']
+            self.add_folder(base, subfolder_path, subfolder)
+
+        services = []
+        for service in folder.get('services', []):
+            services.append({'name': service['service_name'], 'type': service['service_type']})
+            self.add_service(base, service)
+
+        path = f"{base}/{folder_path}" if folder_path else base
+        self.documents[path] = {'currentVersion': 10.91, 'folders': subfolder_names, 'services': services}
+
+    def add_service(self, base, service):
+        service_path = f"{base}/{service['service_name']}/{service['service_type']}"
+        layers = []
+        for layer in service.get('layers', []):
+            layer_id = int(layer['url'].rstrip('/').rsplit('/', 1)[-1])
+            definition = layer_definition(layer, layer_id)
+            self.documents[f"{service_path}/{layer_id}"] = definition
+            self.layers[f"{service_path}/{layer_id}"] = definition
+            layers.append({
+                'id': layer_id,
+                'name': definition['name'],
+                'type': definition['type'],
+                'geometryType': definition['geometryType'],
+                'parentLayerId': -1,
+                'subLayerIds': None
+            })
+        self.documents[service_path] = {'currentVersion': 10.91, 'layers': layers, 'tables': []}
+
+    def make_feature(self, definition, object_id):
+        rng = random.Random(f"{definition['name']}:{object_id}")
+        x = LA_CENTER[0] + rng.uniform(-0.5, 0.5)
+        y = LA_CENTER[1] + rng.uniform(-0.5, 0.5)
+        if definition['geometryType'] == 'esriGeometryPolyline':
+            path = [[x + i * 0.001, y + math.sin(i) * 0.001] for i in range(8)]
+            geometry = {'paths': [path]}
+        elif definition['geometryType'] == 'esriGeometryMultipoint':
+            geometry = {'points': [[x, y], [x + 0.001, y + 0.001]]}
+        else:
+            geometry = {'x': x, 'y': y}
+        attributes = {field['name']: f"{field['name']}-{object_id}" for field in definition['fields'][1:]}
+        attributes[definition['objectIdField']] = object_id
+        return {'attributes': attributes, 'geometry': geometry}
+
+    def query(self, definition, params):
+        total = self.features_per_layer
+        if params.get('returnCountOnly', 'false').lower() == 'true':
+            return {'count': total}
+        offset = int(params.get('resultOffset', 0))
+        count = min(int(params.get('resultRecordCount', MAX_RECORD_COUNT)), MAX_RECORD_COUNT)
+        end = min(offset + count, total)
+        return {
+            'objectIdFieldName': definition['objectIdField'],
+            'geometryType': definition['geometryType'],
+            'spatialReference': {'wkid': 4326, 'latestWkid': 4326},
+            'fields': definition['fields'],
+            'features': [self.make_feature(definition, object_id) for object_id in range(offset + 1, end + 1)],
+            'exceededTransferLimit': end < total
+        }
+
+    async def handle(self, request):
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self.random.uniform(0, self.jitter))
+        if self.error_rate and self.random.random() < self.error_rate:
+            return web.json_response({'error': {'code': 500, 'message': 'Injected error'}}, status=500)
+
+        path = '/' + request.match_info['tail'].rstrip('/')
+        params = dict(request.query)
+        if request.method == 'POST':
+            params.update(await request.post())
+
+        if path.endswith('/query') and path[:-len('/query')] in self.layers:
+            result = self.query(self.layers[path[:-len('/query')]], params)
+            if params.get('f') == 'pbf' and 'features' in result:
+                return web.Response(body=encode_feature_collection(result, params), content_type='application/x-protobuf')
+            return web.json_response(result)
+        if path in self.documents:
+            return web.json_response(self.documents[path])
+        return web.json_response({'error': {'code': 404, 'message': 'Not found'}}, status=404)
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_route('*', '/{tail:.*}', self.handle)
+        return app
+
+def load_metadata(path=DEFAULT_METADATA_PATH):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--metadata', default=DEFAULT_METADATA_PATH)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help="Fixed delay per request in seconds")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Extra random delay per request in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of requests answered with HTTP 500")
+    parser.add_argument('--scale', type=int, default=1, help="Number of copies of each recorded server")
+    parser.add_argument('--features', type=int, default=2000, help="Features served per layer")
+    args = parser.parse_args()
+
+    server = MockArcGISServer(load_metadata(args.metadata), args.latency, args.jitter,
+                              args.error_rate, args.scale, args.features)
+    print(f"Serving {len(server.server_urls)} servers and {len(server.layers)} layers on http://{args.host}:{args.port}")
+    web.run_app(server.make_app(), host=args.host, port=args.port)
+
+if __name__ == '__main__':
+    main()
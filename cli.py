@@ -0,0 +1,48 @@
+"""Single entry point for the pipeline stages.
+
+Only the module of the chosen command is imported, so heavy dependencies (arcgis, osmnx,
+pandas, ...) are loaded by the commands that use them and not by a dry-run or a skipped stage.
+Everything after the command name is passed on to that command.
+
+    python cli.py pipeline --dry-run
+    python cli.py fetch-metadata --shard-index 0 --shard-count 4
+    python cli.py export-tiles --output utility_layers.mbtiles
+"""
+import sys
+import argparse
+import importlib
+import logging
+
+
+# Command name -> (module whose main() runs it, description)
+COMMANDS = {
+    'pipeline': ('pipeline', "Run every stage that is out of date"),
+    'search-servers': ('search_servers', "Search ArcGIS Online for servers and write servers.txt"),
+    'fetch-metadata': ('fetch_metadata', "Crawl the servers in servers.txt"),
+    'merge-shards': ('merge_shards', "Merge the outputs of a sharded crawl"),
+    'search-layers': ('search_relevant_layers', "Find utility layers in the crawled metadata"),
+    'upload': ('upload_to_cockroachdb', "Download the layers in added_layers.json into the database"),
+    'export-tiles': ('vector_tiles', "Export the uploaded layers as vector tiles"),
+    'update-webmap': ('upload_all_layers_to_arcgis', "Add the layers in added_layers.json to the web map")
+}
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        epilog='commands:\n' + '\n'.join(f"  {name:<16}{description}" for name, (_, description) in COMMANDS.items()),
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('command', choices=COMMANDS, metavar='command')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help="Options of the command, see <command> --help")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    module = importlib.import_module(COMMANDS[args.command][0])
+    # The command parses its own options from sys.argv, as when it is run as a script
+    sys.argv = [f"{sys.argv[0]} {args.command}"] + args.args
+    module.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import os
+import json
+import struct
+import logging
+from instrumentation import metrics
+
+
+# Spatial reference features are requested in, also used as the srid stored with each row
+OUT_SR = 4326
+
+# Area of interest pushed to the server as xmin,ymin,xmax,ymax in WGS84 (Los Angeles County incl. the islands)
+AOI_BBOX = [float(value) for value in os.getenv('AOI_BBOX', '-118.9448,32.8007,-117.6462,34.8233').split(',')]
+
+# Generalization tolerance in degrees passed as maxAllowableOffset, 0 disables it (~1e-5 deg is about 1 m)
+GENERALIZE_TOLERANCE = float(os.getenv('GENERALIZE_TOLERANCE', '0.00001'))
+
+# Number of decimal places returned for coordinates
+GEOMETRY_PRECISION = int(os.getenv('GEOMETRY_PRECISION', '6'))
+
+# Fields that are never stored, mostly derived geometry statistics
+EXCLUDED_FIELDS = [
+    'shape_length', 'shape_area', 'shape__length', 'shape__area',
+    'shape.stlength()', 'shape.starea()', 'st_length(shape)', 'st_area(shape)'
+]
+
+# Request features as protocol buffers when the layer supports it ('false' always uses JSON)
+USE_PBF = os.getenv('USE_PBF', 'true').lower() == 'true'
+
+# Page size used when the layer doesn't advertise maxRecordCount
+DEFAULT_PAGE_SIZE = 1000
+
+# Seconds to wait for a server to answer a page request
+REQUEST_TIMEOUT = int(os.getenv('REQUEST_TIMEOUT', '60'))
+
+def aoi_envelope():
+    return {
+        'xmin': AOI_BBOX[0], 'ymin': AOI_BBOX[1],
+        'xmax': AOI_BBOX[2], 'ymax': AOI_BBOX[3],
+        'spatialReference': {'wkid': OUT_SR}
+    }
+
+def aoi_filter():
+    from arcgis.geometry import Envelope
+    from arcgis.geometry.filters import intersects
+
+    return intersects(Envelope(aoi_envelope()), sr=OUT_SR)
+
+def needed_out_fields(feature_layer):
+    fields = feature_layer.properties.get('fields') or []
+    names = [field['name'] for field in fields if field['name'].lower() not in EXCLUDED_FIELDS]
+    return ','.join(names) if names else '*'
+
+def supports_pbf(feature_layer):
+    formats = feature_layer.properties.get('supportedQueryFormats') or ''
+    return 'pbf' in formats.lower()
+
+def supports_pagination(feature_layer):
+    # Without it resultOffset is ignored and every request returns the first page again
+    capabilities = feature_layer.properties.get('advancedQueryCapabilities') or {}
+    return bool(capabilities.get('supportsPagination'))
+
+def query_layer_features_json(feature_layer):
+    query_parameters = {
+        'geometry_filter': aoi_filter(),
+        'out_fields': needed_out_fields(feature_layer),
+        'out_sr': OUT_SR,
+        'geometry_precision': GEOMETRY_PRECISION
+    }
+    if GENERALIZE_TOLERANCE > 0:
+        query_parameters['max_allowable_offset'] = GENERALIZE_TOLERANCE
+    return feature_layer.query(**query_parameters).sdf
+
+def query_layer_features_pbf(feature_layer):
+    """Pages through the layer with f=pbf and decodes each page straight into column and geometry buffers."""
+    import requests
+    from pbf_decoder import decode_feature_collection, feature_results_to_dataframe
+
+    params = {
+        'where': '1=1',
+        'outFields': needed_out_fields(feature_layer),
+        'geometry': json.dumps(aoi_envelope()),
+        'geometryType': 'esriGeometryEnvelope',
+        'inSR': OUT_SR,
+        'spatialRel': 'esriSpatialRelIntersects',
+        'outSR': OUT_SR,
+        'returnGeometry': 'true',
+        # Coordinates come back as integers on a grid of 10^-GEOMETRY_PRECISION degrees
+        'quantizationParameters': json.dumps({
+            'mode': 'edit',
+            'originPosition': 'upperLeft',
+            'tolerance': 10 ** -GEOMETRY_PRECISION,
+            'extent': aoi_envelope()
+        }),
+        'f': 'pbf'
+    }
+    if GENERALIZE_TOLERANCE > 0:
+        params['maxAllowableOffset'] = GENERALIZE_TOLERANCE
+    object_id_field = feature_layer.properties.get('objectIdField')
+    if object_id_field:
+        params['orderByFields'] = object_id_field
+    page_size = feature_layer.properties.get('maxRecordCount') or DEFAULT_PAGE_SIZE
+
+    results = []
+    offset = 0
+    previous_page = None
+    with requests.Session() as session:
+        while True:
+            params['resultOffset'] = offset
+            params['resultRecordCount'] = page_size
+            response = session.get(f"{feature_layer.url}/query", params=params, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            if response.content == previous_page:
+                raise ValueError(f"Page at offset {offset} repeats the previous page, the server ignores resultOffset")
+            previous_page = response.content
+            metrics.increment('pbf_bytes', len(response.content))
+            result = decode_feature_collection(response.content)
+            results.append(result)
+            offset += len(result)
+            if not result.exceeded_transfer_limit or not len(result):
+                break
+    return feature_results_to_dataframe(results)
+
+def query_layer_features(feature_layer):
+    """Downloads the features of a layer that intersect the area of interest as a DataFrame.
+
+    Filtering, field selection and geometry generalization all happen on the server, so only the
+    needed part of the layer is transferred and parsed. PBF is used when the layer supports it
+    and pagination, with the arcgis JSON query as fallback; both return the same columns with geometries in SHAPE.
+    """
+    import requests
+
+    if USE_PBF and supports_pbf(feature_layer) and supports_pagination(feature_layer):
+        try:
+            sdf = query_layer_features_pbf(feature_layer)
+            metrics.increment('pbf_downloads')
+            return sdf
+        except (requests.RequestException, ValueError, IndexError, struct.error) as e:
+            logging.warning(f"PBF query failed for {feature_layer.url}, falling back to JSON: {e}")
+    metrics.increment('json_downloads')
+    return query_layer_features_json(feature_layer)
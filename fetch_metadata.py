@@ -1,17 +1,19 @@
-import aiohttp
+import argparse
 import asyncio
 import logging
 import json
 from tenacity import retry, stop_after_attempt, wait_fixed
 import re
-import nest_asyncio
-from bs4 import BeautifulSoup
+import hashlib
+import itertools
+import os
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+from concurrent.futures import ProcessPoolExecutor
+from instrumentation import metrics
 
 
-nest_asyncio.apply()
-
-logging.basicConfig(level=logging.INFO)
-
 # Define the file paths
 SERVERS_FILE_PATH = 'servers.txt'
 OUTPUT_FILE_PATH = 'all_server_responses.json'
@@ -22,14 +24,106 @@ ALLOWED_GEOMETRY_TYPES = [
     'esriGeometryMultipoint'
 ]
 
+# Layer types that never contain vector features worth fetching
+SKIPPED_LAYER_TYPES = [
+    'Group Layer',
+    'Raster Layer',
+    'Raster Catalog Layer',
+    'Mosaic Layer',
+    'Table'
+]
+
+# Only these service types are crawled (comma-separated in CRAWL_SERVICE_TYPES), everything else
+# (GPServer, ImageServer, GeocodeServer, ...) is skipped
+ALLOWED_SERVICE_TYPES = [
+    service_type.strip()
+    for service_type in os.getenv('CRAWL_SERVICE_TYPES', 'FeatureServer,MapServer').split(',')
+    if service_type.strip()
+]
+
+# Maximum folder depth below the server root to crawl (0 = root services only)
+MAX_CRAWL_DEPTH = int(os.getenv('MAX_CRAWL_DEPTH', '10'))
+
+# Number of folders/services crawled at the same time, shared by all servers
+CRAWL_CONCURRENCY = int(os.getenv('CRAWL_CONCURRENCY', '10'))
+
+# Number of completed JSON responses kept for the rest of the run, least recently used evicted first
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '4096'))
+
+# Folders whose names contain one of these are crawled first
+UTILITY_FOLDER_KEYWORDS = [
+    'util', 'water', 'sewer', 'storm', 'drain', 'gas', 'electric',
+    'power', 'pipe', 'sanitation', 'hydrant', 'telecom', 'fiber',
+    'publicworks', 'public_works', 'infrastructure'
+]
+
+# Worker pool used for HTML description cleanup so parsing doesn't block the event loop
+description_executor = None
+
+# Cleaned descriptions keyed by the SHA-1 of the raw HTML, shared by all layers in the run
+description_cache = {}
+
+# Responses of completed requests and futures of requests in flight, keyed by request_key()
+response_cache = OrderedDict()
+in_flight_requests = {}
+
+# Seconds the server took to answer each request actually sent, keyed by request_key()
+response_times = {}
+
 def normalize_url(url):
     # Remove duplicate slashes but keep the "http://" or "https://"
     return re.sub(r'(?<!:)/{2,}', '/', url)
 
+def request_key(url):
+    # The same resource with or without a trailing slash before the query string
+    return re.sub(r'/+(\?|$)', r'\1', normalize_url(url))
+
+def remember_response(key, data):
+    response_cache[key] = data
+    response_cache.move_to_end(key)
+    while len(response_cache) > RESPONSE_CACHE_SIZE:
+        response_cache.popitem(last=False)
+        metrics.increment('fetch_cache_evictions')
+
 async def fetch(session, url):
-    logging.info(f"Fetching URL: {url}")
+    """Fetches a JSON response at most once per run.
+
+    Concurrent callers of the same URL share the request in flight, later callers get the
+    cached response. Failed requests are not cached, so retries go back to the server.
+    Responses are shared between callers and must not be modified.
+    """
+    key = request_key(url)
+    if key in response_cache:
+        response_cache.move_to_end(key)
+        metrics.increment('fetch_cache_hits')
+        return response_cache[key]
+
+    future = in_flight_requests.get(key)
+    if future is not None:
+        metrics.increment('fetch_coalesced')
+    else:
+        metrics.increment('fetch_cache_misses')
+        future = asyncio.ensure_future(fetch_uncached(session, url))
+        in_flight_requests[key] = future
+
+        def request_done(future):
+            in_flight_requests.pop(key, None)
+            if not future.cancelled() and future.exception() is None:
+                remember_response(key, future.result())
+
+        future.add_done_callback(request_done)
+    # A cancelled caller must not cancel the request the other callers are waiting for
+    return await asyncio.shield(future)
+
+async def fetch_uncached(session, url):
+    import aiohttp
+
+    logging.debug("Fetching URL: %s", url)
+    metrics.increment('requests')
+    start = time.perf_counter()
     async with session.get(url) as response:
         if response.status != 200:
+            metrics.increment('request_errors')
             logging.error(f"Failed to fetch {url}: {response.status}")
             raise aiohttp.ClientResponseError(
                 status=response.status,
@@ -38,45 +132,126 @@ async def fetch(session, url):
                 history=response.history
             )
         data = await response.json()
-        logging.info(f"Data fetched from {url}")
+        seconds = time.perf_counter() - start
+        response_times[request_key(url)] = seconds
+        metrics.observe_host(url, seconds)
+        logging.debug("Data fetched from %s", url)
         return data
 
+def html_to_text(description_html):
+    from bs4 import BeautifulSoup
+
+    return BeautifulSoup(description_html, 'html.parser').get_text()
+
+async def clean_description(description_html):
+    """Returns the plain text of a description, parsing each distinct HTML once per run in the worker pool."""
+    # Fast path: plain text without tags or entities doesn't need parsing
+    if '<' not in description_html and '&' not in description_html:
+        metrics.increment('descriptions_plain')
+        return description_html
+
+    key = hashlib.sha1(description_html.encode('utf-8')).hexdigest()
+    future = description_cache.get(key)
+    if future is not None:
+        metrics.increment('descriptions_cached')
+    else:
+        metrics.increment('descriptions_parsed')
+        # Cache the future itself so concurrent layers with the same description share one parse
+        loop = asyncio.get_running_loop()
+        future = asyncio.ensure_future(loop.run_in_executor(description_executor, html_to_text, description_html))
+        description_cache[key] = future
+
+        def parse_done(future):
+            # A failed parse is not cached, the next layer with this description tries again
+            if future.cancelled() or future.exception() is not None:
+                metrics.increment('description_errors')
+                if description_cache.get(key) is future:
+                    del description_cache[key]
+
+        future.add_done_callback(parse_done)
+    # A cancelled caller must not cancel the parse the other layers are waiting for
+    return await asyncio.shield(future)
+
+def is_candidate_layer(layer):
+    # Use whatever the service listing already tells us about the layer to avoid fetching it
+    if layer.get('subLayerIds'):
+        return False
+    if layer.get('type') in SKIPPED_LAYER_TYPES:
+        return False
+    geometry_type = layer.get('geometryType')
+    if geometry_type and geometry_type not in ALLOWED_GEOMETRY_TYPES:
+        return False
+    return True
+
 @retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
 async def get_folders_and_services(session, url):
     return await fetch(session, f"{url}?f=json")
 
+def summarize_extent(extent):
+    if not extent or extent.get('xmin') in (None, 'NaN'):
+        return None
+    spatial_reference = extent.get('spatialReference') or {}
+    return {
+        'xmin': round(extent['xmin'], 3),
+        'ymin': round(extent['ymin'], 3),
+        'xmax': round(extent['xmax'], 3),
+        'ymax': round(extent['ymax'], 3),
+        'wkid': spatial_reference.get('latestWkid') or spatial_reference.get('wkid')
+    }
+
+async def get_feature_count(session, layer_url):
+    try:
+        result = await fetch(session, normalize_url(f"{layer_url}/query?where=1%3D1&returnCountOnly=true&f=json"))
+        return result.get('count')
+    except Exception as e:
+        logging.debug("Could not count features of %s: %s", layer_url, e)
+        return None
+
 async def get_layer_metadata(session, layer_url):
     url = normalize_url(f"{layer_url}?f=json")
     layer_metadata = await fetch(session, url)
+    # The time of the request that was sent, not of this call, which may have been answered from the cache
+    response_seconds = response_times.get(request_key(url))
     
     fields = layer_metadata.get('fields', [])
     description_html = layer_metadata.get('description', 'No description available')
-    description = BeautifulSoup(description_html, 'html.parser').get_text()
     geometry_type = layer_metadata.get('geometryType', 'Unknown')
     layer_name = layer_metadata.get('name', 'No name available')
     
     if geometry_type not in ALLOWED_GEOMETRY_TYPES:
+        metrics.increment('layers_rejected')
         return None
 
+    metrics.increment('layers_kept')
+    with metrics.span('transform'):
+        description = await clean_description(description_html or '')
+
     return {
         'layer_name': layer_name,
         'fields': [field['name'] for field in fields] if fields else [],
         'description': description,
         'geometry_type': geometry_type,
-        'url': layer_url
+        'url': layer_url,
+        'extent': summarize_extent(layer_metadata.get('extent')),
+        'response_seconds': round(response_seconds, 3) if response_seconds is not None else None
     }
 
 async def get_service_details(session, base_url, service):
     service_name = service['name']
     service_type = service['type']
-    if service_type not in ["FeatureServer", "MapServer"]:
+    if service_type not in ALLOWED_SERVICE_TYPES:
         return None
     
     service_url = normalize_url(f"{base_url}/{service_name}/{service_type}?f=json")
     service_metadata = await fetch(session, service_url)
 
     tasks = []
-    for layer in service_metadata.get('layers', []):
+    # Tables are listed separately under 'tables' and are never fetched
+    layers = service_metadata.get('layers', [])
+    candidates = [layer for layer in layers if is_candidate_layer(layer)]
+    metrics.increment('layers_pruned', len(layers) - len(candidates))
+    logging.debug("%d of %d layers are candidates in %s", len(candidates), len(layers), service_url)
+    for layer in candidates:
         layer_url = normalize_url(f"{base_url}/{service_name}/{service_type}/{layer['id']}")
         tasks.append(get_layer_metadata(session, layer_url))
     
@@ -92,80 +267,218 @@ async def get_service_details(session, base_url, service):
         'layers': details
     }
 
-async def process_folder(session, base_url, folder_path):
-    folder_url = normalize_url(f"{base_url}/{folder_path}")
-    folders_and_services = await get_folders_and_services(session, folder_url)
-    
-    results = {
-        'folder_name': folder_path.split('/')[-1],  # Get the last part of the path as the folder name
-        'services': [],
-        'subfolders': []
-    }
-    
-    # Process services
-    services = folders_and_services.get('services', [])
-    for service in services:
-        service_details = await get_service_details(session, base_url, service)
-        if service_details:
-            results['services'].append(service_details)
-    
-    # Process subfolders
-    subfolders = folders_and_services.get('folders', [])
-    for subfolder in subfolders:
-        subfolder_path = f"{folder_path}/{subfolder}"
-        subfolder_details = await process_folder(session, base_url, subfolder_path)
-        results['subfolders'].append(subfolder_details)
-    
-    if not results['services'] and not results['subfolders']:
-        return None
+def folder_priority(folder_path):
+    folder_name = folder_path.split('/')[-1].lower()
+    return 0 if any(keyword in folder_name for keyword in UTILITY_FOLDER_KEYWORDS) else 1
 
-    return results
+class ServerCrawl:
+    """Crawl state of one server in the shared work queue: the URLs it has queued and the folders listed so far."""
 
-async def process_server(session, base_url):
-    folders_and_services = await get_folders_and_services(session, base_url)
-    
-    results = {
-        'services': [],
-        'folders': []
-    }
-    
-    # Process root services
-    services = folders_and_services.get('services', [])
-    for service in services:
-        service_details = await get_service_details(session, base_url, service)
-        if service_details:
-            results['services'].append(service_details)
-    
-    # Process folders
-    folders = folders_and_services.get('folders', [])
-    tasks = [process_folder(session, base_url, folder) for folder in folders]
-    folder_details = await asyncio.gather(*tasks)
-    folder_details = [folder for folder in folder_details if folder]  # Remove None values
-    results['folders'].extend(folder_details)
-    
-    if not results['services'] and not results['folders']:
-        return None
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.visited = set()
+        self.folders = {}  # folder path -> folder results, '' is the server root
+        self.root_error = None
+        self.pending = 0
+        self.start = None
+
+    def results(self):
+        """Rebuilds the nested folder structure, dropping folders without any matching services."""
+        children = {}
+        for folder_path in self.folders:
+            if folder_path:
+                parent = folder_path.rsplit('/', 1)[0] if '/' in folder_path else ''
+                children.setdefault(parent, []).append(folder_path)
+
+        def build_folder(folder_path):
+            results = self.folders[folder_path]
+            results['services'].sort(key=lambda service: service['service_name'])
+            subfolders = [build_folder(child) for child in sorted(children.get(folder_path, []))]
+            results['subfolders'] = [subfolder for subfolder in subfolders if subfolder]
+            if not results['services'] and not results['subfolders']:
+                return None
+            return results
+
+        root = build_folder('') if '' in self.folders else None
+        if not root:
+            return None
+
+        return {
+            'services': root['services'],
+            'folders': root['subfolders']
+        }
+
+async def crawl_queue(session, servers, max_depth=MAX_CRAWL_DEPTH, service_types=ALLOWED_SERVICE_TYPES):
+    """Crawls servers breadth-first from one work queue shared by all of them instead of recursing into folders.
+
+    CRAWL_CONCURRENCY workers take folders and services of any server from the queue, so a server
+    with few folders doesn't leave workers idle and a slow server doesn't hold up the others.
+    Folders and services are deduplicated by URL, folders deeper than max_depth are not listed,
+    services whose type is not in service_types are never requested, and utility-looking folders
+    are crawled before everything else. Returns a ServerCrawl per server; root_error is set on
+    those whose root couldn't be listed.
+    """
+    queue = asyncio.PriorityQueue()
+    sequence = itertools.count()
 
-    return results
+    def enqueue(crawl, priority, depth, kind, folder_path, item):
+        crawl.pending += 1
+        queue.put_nowait((priority, depth, next(sequence), kind, crawl, folder_path, item))
 
-async def main():
-    async with aiohttp.ClientSession() as session:
-        with open(SERVERS_FILE_PATH, 'r') as file:
-            servers = [normalize_url(line.strip()) for line in file if line.strip()]
-        
-        all_results = {}
-        for server in servers:
+    def enqueue_folder(crawl, folder_path, depth):
+        folder_url = normalize_url(f"{crawl.base_url}/{folder_path}") if folder_path else crawl.base_url
+        if depth > max_depth or folder_url in crawl.visited:
+            return
+        crawl.visited.add(folder_url)
+        enqueue(crawl, folder_priority(folder_path), depth, 'folder', folder_path, folder_url)
+
+    async def process_folder(crawl, folder_path, folder_url, priority, depth):
+        folders_and_services = await get_folders_and_services(session, folder_url)
+        crawl.folders[folder_path] = {
+            'folder_name': folder_path.split('/')[-1],  # Get the last part of the path as the folder name
+            'services': [],
+            'subfolders': []
+        }
+
+        for service in folders_and_services.get('services', []):
+            if service.get('type') not in service_types:
+                continue
+            service_url = normalize_url(f"{crawl.base_url}/{service['name']}/{service['type']}")
+            if service_url in crawl.visited:
+                continue
+            crawl.visited.add(service_url)
+            enqueue(crawl, priority, depth, 'service', folder_path, service)
+
+        for subfolder in folders_and_services.get('folders', []):
+            enqueue_folder(crawl, f"{folder_path}/{subfolder}" if folder_path else subfolder, depth + 1)
+
+    async def worker():
+        while True:
+            priority, depth, _, kind, crawl, folder_path, item = await queue.get()
+            if crawl.start is None:
+                crawl.start = time.perf_counter()
             try:
-                server_results = await process_server(session, server)
-                if server_results:
-                    all_results[server] = server_results
+                if kind == 'folder':
+                    await process_folder(crawl, folder_path, item, priority, depth)
+                else:
+                    service_details = await get_service_details(session, crawl.base_url, item)
+                    if service_details:
+                        crawl.folders[folder_path]['services'].append(service_details)
             except Exception as e:
-                logging.error(f"Error processing server {server}: {e}")
+                if kind == 'folder' and not folder_path:
+                    # Without its root listing the server wasn't crawled at all
+                    crawl.root_error = e
+                logging.error(f"Error processing {kind} {item if kind == 'folder' else item.get('name')}: {e}")
+            finally:
+                crawl.pending -= 1
+                if not crawl.pending:
+                    metrics.observe('server', crawl.base_url, time.perf_counter() - crawl.start)
+                queue.task_done()
+
+    crawls = [ServerCrawl(server) for server in servers]
+    for crawl in crawls:
+        enqueue_folder(crawl, '', 0)
+    workers = [asyncio.ensure_future(worker()) for _ in range(CRAWL_CONCURRENCY)]
+    try:
+        await queue.join()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    return crawls
+
+async def crawl_servers(servers, failed_servers=None):
+    """Crawls the servers and returns the results keyed by server URL, leaving out servers without matches.
+
+    Servers whose root couldn't be listed are appended to failed_servers when a list is given.
+    """
+    import aiohttp
+
+    global description_executor
+    description_executor = ProcessPoolExecutor()
+    response_cache.clear()
+    in_flight_requests.clear()
+    response_times.clear()
+    # The cached futures belong to the previous run's executor and event loop
+    description_cache.clear()
+    all_results = {}
+    try:
+        async with aiohttp.ClientSession() as session:
+            with metrics.span('crawl'):
+                crawls = await crawl_queue(session, servers)
+    finally:
+        description_executor.shutdown()
+
+    for crawl in crawls:
+        if crawl.root_error is not None:
+            metrics.increment('server_errors')
+            logging.error(f"Error processing server {crawl.base_url}: {crawl.root_error}")
+            if failed_servers is not None:
+                failed_servers.append(crawl.base_url)
+            continue
+        server_results = crawl.results()
+        if server_results:
+            all_results[crawl.base_url] = server_results
+    saved = metrics.counters.get('fetch_cache_hits', 0) + metrics.counters.get('fetch_coalesced', 0)
+    logging.info(f"Response cache saved {saved} of {saved + metrics.counters.get('fetch_cache_misses', 0)} requests")
+    return all_results
+
+def read_servers(path=SERVERS_FILE_PATH):
+    with open(path, 'r') as file:
+        return list(dict.fromkeys(normalize_url(line.strip()) for line in file if line.strip()))
+
+def server_partition_key(server):
+    # The host plus the site path before /rest/ (the org id on ArcGIS Online hosts), so all roots
+    # of one server site land in the same shard while the shared arcgis.com hosts still spread out
+    parsed = urlparse(server)
+    site_path = parsed.path.lower().split('/rest/')[0].strip('/')
+    return f"{parsed.netloc.lower()}/{site_path}"
+
+def server_shard(server, shard_count):
+    key = server_partition_key(server)
+    return int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16) % shard_count
+
+def select_shard(servers, shard_index, shard_count):
+    return [server for server in servers if server_shard(server, shard_count) == shard_index]
+
+def shard_output_path(shard_index, shard_count, output_path=OUTPUT_FILE_PATH):
+    base, extension = os.path.splitext(output_path)
+    return f"{base}.shard-{shard_index}-of-{shard_count}{extension}"
+
+async def crawl_to_file(shard_index=None, shard_count=None):
+    """Crawls servers.txt into OUTPUT_FILE_PATH, or one shard of it into its shard file when a shard is given.
+
+    A shard file is written even for a single shard, so merge_shards.py finds the output of any shard count.
+    """
+    servers = read_servers(SERVERS_FILE_PATH)
+    output_path = OUTPUT_FILE_PATH
+    if shard_count is not None:
+        servers = select_shard(servers, shard_index, shard_count)
+        output_path = shard_output_path(shard_index, shard_count)
+        logging.info(f"Crawling shard {shard_index} of {shard_count}: {len(servers)} servers")
+
+    all_results = await crawl_servers(servers)
+
+    # Save the results to a JSON file
+    with open(output_path, 'w') as f:
+        json.dump(all_results, f, indent=4)
+    logging.info(f"Saved all responses to: {output_path}")
+    metrics.write_report('fetch_metadata' if shard_count is None else f"fetch_metadata.shard-{shard_index}-of-{shard_count}")
 
-        # Save the results to a JSON file
-        with open(OUTPUT_FILE_PATH, 'w') as f:
-            json.dump(all_results, f, indent=4)
-        logging.info(f"Saved all responses to: {OUTPUT_FILE_PATH}")
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Crawl the ArcGIS servers listed in servers.txt")
+    parser.add_argument('--shard-index', type=int, default=os.getenv('SHARD_INDEX'))
+    parser.add_argument('--shard-count', type=int, default=os.getenv('SHARD_COUNT'))
+    args = parser.parse_args()
+    if args.shard_index is None and args.shard_count is None:
+        asyncio.run(crawl_to_file())
+        return
+    shard_index = args.shard_index if args.shard_index is not None else 0
+    shard_count = args.shard_count if args.shard_count is not None else 1
+    if not 0 <= shard_index < shard_count:
+        parser.error("--shard-index must be between 0 and --shard-count - 1")
+    asyncio.run(crawl_to_file(shard_index, shard_count))
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    main()
@@ -0,0 +1,101 @@
+import json
+import os
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+
+# Directory the run reports are written to
+REPORTS_DIR = os.getenv('REPORTS_DIR', 'reports')
+
+# Upper bounds in seconds of the latency histogram buckets, the last bucket is open-ended
+LATENCY_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+class Histogram:
+    """Fixed-bucket latency histogram with count, total, min and max."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def to_dict(self):
+        labels = [f"<={bound}" for bound in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]}"]
+        return {
+            'count': self.count,
+            'total_seconds': round(self.total, 6),
+            'mean_seconds': round(self.total / self.count, 6) if self.count else None,
+            'min_seconds': self.min,
+            'max_seconds': self.max,
+            'buckets': {label: count for label, count in zip(labels, self.buckets) if count}
+        }
+
+class Metrics:
+    """Collects stage spans, counters and grouped latency histograms for one run.
+
+    Safe to use from threads and from asyncio code; spans measure wall-clock time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.spans = {}
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, group, key, seconds):
+        with self.lock:
+            self.histograms.setdefault(group, {}).setdefault(key, Histogram()).observe(seconds)
+
+    def observe_host(self, url, seconds):
+        self.observe('host', urlparse(url).netloc, seconds)
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.spans.setdefault(stage, Histogram()).observe(elapsed)
+
+    def report(self):
+        with self.lock:
+            return {
+                'started': self.started,
+                'elapsed_seconds': round(time.time() - self.started, 6),
+                'spans': {stage: histogram.to_dict() for stage, histogram in self.spans.items()},
+                'counters': dict(self.counters),
+                'histograms': {
+                    group: {key: histogram.to_dict() for key, histogram in sorted(histograms.items())}
+                    for group, histograms in self.histograms.items()
+                }
+            }
+
+    def write_report(self, name):
+        os.makedirs(REPORTS_DIR, exist_ok=True)
+        path = os.path.join(REPORTS_DIR, f"{name}.json")
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=4)
+        logging.info(f"Saved run report to: {path}")
+        return path
+
+# Shared instance used by the pipeline scripts
+metrics = Metrics()
@@ -0,0 +1,84 @@
+"""Merges the shard outputs of `fetch_metadata.py --shard-index i --shard-count n` into one catalog.
+
+    python merge_shards.py all_server_responses.shard-*.json
+"""
+import argparse
+import glob
+import json
+import logging
+
+
+OUTPUT_FILE_PATH = 'all_server_responses.json'
+
+def server_key(server):
+    return server.rstrip('/')
+
+def dedup_folder(folder, seen_layers):
+    """Drops layers already seen under another server or folder, then services and folders left empty."""
+    services = []
+    for service in folder.get('services', []):
+        layers = [layer for layer in service.get('layers', []) if layer['url'] not in seen_layers]
+        seen_layers.update(layer['url'] for layer in layers)
+        if layers:
+            services.append(dict(service, layers=layers))
+
+    folder_key = 'folders' if 'folders' in folder else 'subfolders'
+    subfolders = []
+    for subfolder in folder.get(folder_key, []):
+        subfolder = dedup_folder(subfolder, seen_layers)
+        if subfolder:
+            subfolders.append(subfolder)
+
+    if not services and not subfolders:
+        return None
+    return dict(folder, services=services, **{folder_key: subfolders})
+
+def merge_results(shard_results):
+    """Combines shard outputs, sorted by server URL so the catalog doesn't depend on shard order.
+
+    A server crawled more than once (e.g. listed with and without a trailing slash) is kept once,
+    and a layer reachable from several servers is kept under the first server in sorted order.
+    """
+    servers = {}
+    for results in shard_results:
+        for server, server_results in results.items():
+            key = server_key(server)
+            if key in servers:
+                logging.warning(f"Server {server} appears more than once, keeping one copy")
+                # Keep the same copy whatever order the shards are read in
+                if server >= servers[key][0]:
+                    continue
+            servers[key] = (server, server_results)
+
+    merged = {}
+    seen_layers = set()
+    for key in sorted(servers):
+        server, server_results = servers[key]
+        server_results = dedup_folder(server_results, seen_layers)
+        if server_results:
+            merged[server] = server_results
+    return merged
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('shards', nargs='*', help="Shard files, defaults to all_server_responses.shard-*.json")
+    parser.add_argument('--output', default=OUTPUT_FILE_PATH)
+    args = parser.parse_args()
+
+    paths = sorted(args.shards or glob.glob('all_server_responses.shard-*.json'))
+    if not paths:
+        parser.error("No shard files found")
+
+    shard_results = []
+    for path in paths:
+        with open(path, 'r') as f:
+            shard_results.append(json.load(f))
+
+    merged = merge_results(shard_results)
+    with open(args.output, 'w') as f:
+        json.dump(merged, f, indent=4)
+    logging.info(f"Merged {len(paths)} shards into {args.output}: {len(merged)} servers")
+
+if __name__ == '__main__':
+    main()
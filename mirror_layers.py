@@ -0,0 +1,159 @@
+import os
+import re
+import asyncio
+import hashlib
+import logging
+from urllib.parse import urlparse
+
+
+# Fields that differ between copies of the same data without changing it (ids and geometry statistics)
+IGNORED_FIELDS = [
+    'objectid', 'fid', 'oid', 'globalid', 'shape', 'shape_length', 'shape_area',
+    'shape__length', 'shape__area', 'shape.stlength()', 'shape.starea()'
+]
+
+# Extents overlapping at least this much (intersection over union) are considered the same
+MIN_EXTENT_OVERLAP = 0.95
+
+# Feature counts within this fraction of each other are considered the same
+MAX_COUNT_DIFFERENCE = 0.01
+
+# Request the feature counts of layers that could be mirrors of another layer on a different service
+COUNT_FEATURES = os.getenv('COUNT_FEATURES', 'true').lower() == 'true'
+
+# Number of count requests in flight
+COUNT_CONCURRENCY = int(os.getenv('COUNT_CONCURRENCY', '10'))
+
+def normalize_name(name):
+    return re.sub(r'[^a-z0-9]+', '', (name or '').lower())
+
+def schema_key(layer):
+    """Name, sorted field list and geometry type: layers can only be mirrors if these match."""
+    fields = sorted({field.lower() for field in layer.get('fields', [])} - set(IGNORED_FIELDS))
+    geometry_type = layer.get('geometry_type')
+    key = '|'.join([normalize_name(layer.get('layer_name')), geometry_type or '', ','.join(fields)])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def layer_fingerprint(layer):
+    """Exact fingerprint of a layer from its schema, extent and feature count."""
+    extent = layer.get('extent') or {}
+    key = '|'.join([
+        schema_key(layer),
+        ','.join(str(extent.get(side)) for side in ('xmin', 'ymin', 'xmax', 'ymax', 'wkid')),
+        str(layer.get('feature_count'))
+    ])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def service_layer_id(url):
+    """The service path and layer id, identical for the MapServer and FeatureServer of one service."""
+    parsed = urlparse(url)
+    path = re.sub(r'/(MapServer|FeatureServer)/', '/', parsed.path, flags=re.IGNORECASE)
+    return f"{parsed.netloc.lower()}{path.lower().rstrip('/')}"
+
+def extent_overlap(a, b):
+    width = min(a['xmax'], b['xmax']) - max(a['xmin'], b['xmin'])
+    height = min(a['ymax'], b['ymax']) - max(a['ymin'], b['ymin'])
+    if width < 0 or height < 0:
+        return 0.0
+    intersection = width * height
+    union = (a['xmax'] - a['xmin']) * (a['ymax'] - a['ymin']) + (b['xmax'] - b['xmin']) * (b['ymax'] - b['ymin']) - intersection
+    if union <= 0:
+        # Degenerate extents (a single point or a line) only match when identical
+        return 1.0 if a == b else 0.0
+    return intersection / union
+
+def counts_match(a, b):
+    if a is None or b is None:
+        return False
+    if a == b:
+        return True
+    return abs(a - b) <= MAX_COUNT_DIFFERENCE * max(a, b)
+
+def is_mirror(a, b):
+    if service_layer_id(a['url']) == service_layer_id(b['url']):
+        return True
+    if not counts_match(a.get('feature_count'), b.get('feature_count')):
+        return False
+    extent_a, extent_b = a.get('extent'), b.get('extent')
+    if extent_a and extent_b and extent_a.get('wkid') == extent_b.get('wkid'):
+        return extent_overlap(extent_a, extent_b) >= MIN_EXTENT_OVERLAP
+    # Without comparable extents only an identical, non-zero feature count is trusted
+    return a.get('feature_count') == b.get('feature_count') and a.get('feature_count', 0) > 0
+
+def representative_rank(layer):
+    """Sort key for choosing the copy to download: FeatureServer first, then the fastest host."""
+    is_feature_server = '/featureserver/' in layer['url'].lower()
+    response_seconds = layer.get('response_seconds')
+    return (
+        not is_feature_server,
+        response_seconds if response_seconds is not None else float('inf'),
+        layer['url']
+    )
+
+async def fetch_feature_counts(layer_urls):
+    import aiohttp
+    from fetch_metadata import get_feature_count
+
+    semaphore = asyncio.Semaphore(COUNT_CONCURRENCY)
+
+    async def count(session, layer_url):
+        async with semaphore:
+            return await get_feature_count(session, layer_url)
+
+    async with aiohttp.ClientSession() as session:
+        return await asyncio.gather(*(count(session, layer_url) for layer_url in layer_urls))
+
+def add_feature_counts(layers):
+    """Returns the layers with feature_count set on those that need it to be compared.
+
+    Only layers sharing their schema key with a layer of another service can be mirrors by count
+    and extent, so only those are counted, after the keyword search instead of during the crawl.
+    """
+    buckets = {}
+    for layer in layers:
+        buckets.setdefault(schema_key(layer), []).append(layer)
+    candidates = [
+        layer for bucket in buckets.values()
+        if len({service_layer_id(member['url']) for member in bucket}) > 1
+        for layer in bucket if layer.get('feature_count') is None
+    ]
+    if not COUNT_FEATURES or not candidates:
+        return layers
+
+    counts = asyncio.run(fetch_feature_counts([layer['url'] for layer in candidates]))
+    logging.info(f"Counted the features of {len(candidates)} of {len(layers)} layers")
+    counted = {id(layer): count for layer, count in zip(candidates, counts)}
+    return [dict(layer, feature_count=counted[id(layer)]) if id(layer) in counted else layer for layer in layers]
+
+def cluster_mirror_layers(layers):
+    """Groups exact and near-duplicate layers; returns clusters with the representative first."""
+    buckets = {}
+    for layer in layers:
+        buckets.setdefault(schema_key(layer), []).append(layer)
+
+    clusters = []
+    for bucket in buckets.values():
+        bucket_clusters = []
+        for layer in sorted(bucket, key=representative_rank):
+            for cluster in bucket_clusters:
+                if any(is_mirror(layer, member) for member in cluster):
+                    cluster.append(layer)
+                    break
+            else:
+                bucket_clusters.append([layer])
+        clusters.extend(bucket_clusters)
+    return clusters
+
+def dedup_mirror_layers(layers):
+    """Keeps one representative per mirror cluster, with the other copies' URLs under 'mirrors'."""
+    layers = add_feature_counts(layers)
+    order = {id(layer): index for index, layer in enumerate(layers)}
+    representatives = []
+    for cluster in cluster_mirror_layers(layers):
+        representative = dict(cluster[0], fingerprint=layer_fingerprint(cluster[0]))
+        representative['mirrors'] = [layer['url'] for layer in cluster[1:]]
+        representatives.append((min(order[id(layer)] for layer in cluster), representative))
+    # Keep the catalog order of the first copy of each cluster
+    representatives = [representative for _, representative in sorted(representatives, key=lambda item: item[0])]
+    logging.info(f"{len(layers)} layers form {len(representatives)} mirror clusters")
+    return representatives
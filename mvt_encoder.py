@@ -0,0 +1,113 @@
+import struct
+
+
+# Encoder for Mapbox Vector Tile (vector_tile.proto, version 2) layers, the write-side
+# counterpart of pbf_decoder.py. Each call produces a complete Tile message holding a single
+# layer; since repeated fields of concatenated protobuf messages are merged, the tiles of
+# several layers can be joined with b''.join(...) into one multi-layer tile.
+
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LENGTH_DELIMITED = 2
+
+# Tile.GeomType
+GEOMETRY_POINT = 1
+GEOMETRY_LINESTRING = 2
+
+# Geometry commands
+COMMAND_MOVE_TO = 1
+COMMAND_LINE_TO = 2
+
+LAYER_VERSION = 2
+
+def encode_varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+def encode_key(field_number, wire_type):
+    return encode_varint((field_number << 3) | wire_type)
+
+def encode_varint_field(field_number, value):
+    return encode_key(field_number, WIRE_VARINT) + encode_varint(value)
+
+def encode_bytes_field(field_number, payload):
+    return encode_key(field_number, WIRE_LENGTH_DELIMITED) + encode_varint(len(payload)) + payload
+
+def encode_packed_field(field_number, values):
+    return encode_bytes_field(field_number, b''.join(encode_varint(value) for value in values))
+
+def encode_value(value):
+    """Tile.Value: strings, doubles, bools and 64-bit integers (sint64 for negative values)."""
+    if isinstance(value, bool):
+        return encode_varint_field(7, int(value))
+    if isinstance(value, int) and -2 ** 63 <= value < 2 ** 64:
+        if value < 0:
+            return encode_varint_field(6, zigzag(value))
+        return encode_varint_field(5, value)
+    if isinstance(value, float):
+        return encode_key(3, WIRE_FIXED64) + struct.pack('<d', value)
+    return encode_bytes_field(1, str(value).encode('utf-8'))
+
+def command(command_id, count):
+    return (command_id & 0x7) | (count << 3)
+
+def encode_geometry(geometry_type, parts):
+    """Geometry command stream for points or lines given as lists of integer (x, y) tile coordinates."""
+    commands = []
+    cursor_x = cursor_y = 0
+
+    def append_points(points):
+        nonlocal cursor_x, cursor_y
+        for x, y in points:
+            commands.append(zigzag(x - cursor_x))
+            commands.append(zigzag(y - cursor_y))
+            cursor_x, cursor_y = x, y
+
+    if geometry_type == GEOMETRY_POINT:
+        points = [point for part in parts for point in part]
+        commands.append(command(COMMAND_MOVE_TO, len(points)))
+        append_points(points)
+    else:
+        for part in parts:
+            commands.append(command(COMMAND_MOVE_TO, 1))
+            append_points(part[:1])
+            commands.append(command(COMMAND_LINE_TO, len(part) - 1))
+            append_points(part[1:])
+    return commands
+
+def encode_layer(name, features, extent=4096):
+    """Encodes one layer as a Tile message.
+
+    features is a list of (geometry type, parts, properties) with parts already clipped,
+    simplified and quantized to integer tile coordinates. Keys and values are deduplicated
+    across the layer's features.
+    """
+    keys = {}
+    values = {}
+    encoded_features = []
+    for geometry_type, parts, properties in features:
+        tags = []
+        for key, value in properties.items():
+            tags.append(keys.setdefault(key, len(keys)))
+            # bools and ints compare equal (True == 1), so the type is part of the lookup key
+            tags.append(values.setdefault((type(value), value), len(values)))
+        feature = b''
+        if tags:
+            feature += encode_packed_field(2, tags)
+        feature += encode_varint_field(3, geometry_type)
+        feature += encode_packed_field(4, encode_geometry(geometry_type, parts))
+        encoded_features.append(feature)
+
+    layer = encode_varint_field(15, LAYER_VERSION) + encode_bytes_field(1, name.encode('utf-8'))
+    layer += b''.join(encode_bytes_field(2, feature) for feature in encoded_features)
+    layer += b''.join(encode_bytes_field(3, key.encode('utf-8')) for key in keys)
+    layer += b''.join(encode_bytes_field(4, encode_value(value)) for _, value in values)
+    layer += encode_varint_field(5, extent)
+    return encode_bytes_field(3, layer)
@@ -0,0 +1,336 @@
+import struct
+import numpy as np
+import pandas as pd
+
+
+# Decoder for the esriPBuffer.FeatureCollectionPBuffer messages returned by `query?f=pbf`.
+# Only the parts of FeatureCollection.proto needed to rebuild features are read, everything
+# else is skipped by wire type, so no generated protobuf module is required.
+
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LENGTH_DELIMITED = 2
+WIRE_FIXED32 = 5
+
+# FeatureCollectionPBuffer.GeometryType
+GEOMETRY_TYPES = {
+    0: 'esriGeometryPoint',
+    1: 'esriGeometryMultipoint',
+    2: 'esriGeometryPolyline',
+    3: 'esriGeometryPolygon',
+    4: 'esriGeometryMultipatch',
+    127: 'esriGeometryNull'
+}
+
+# FeatureCollectionPBuffer.FieldType
+FIELD_TYPES = {
+    0: 'esriFieldTypeSmallInteger',
+    1: 'esriFieldTypeInteger',
+    2: 'esriFieldTypeSingle',
+    3: 'esriFieldTypeDouble',
+    4: 'esriFieldTypeString',
+    5: 'esriFieldTypeDate',
+    6: 'esriFieldTypeOID',
+    7: 'esriFieldTypeGeometry',
+    8: 'esriFieldTypeBlob',
+    9: 'esriFieldTypeRaster',
+    10: 'esriFieldTypeGUID',
+    11: 'esriFieldTypeGlobalID',
+    12: 'esriFieldTypeXML'
+}
+
+INTEGER_FIELD_TYPES = ['esriFieldTypeSmallInteger', 'esriFieldTypeInteger', 'esriFieldTypeOID']
+FLOAT_FIELD_TYPES = ['esriFieldTypeSingle', 'esriFieldTypeDouble']
+
+# FeatureCollectionPBuffer.QuantizeOriginPostion
+ORIGIN_UPPER_LEFT = 0
+
+def read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+def zigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+def iter_fields(buf, start=0, end=None):
+    """Yields (field number, wire type, value) for each field of a message.
+
+    Varints are returned as ints, fixed-size values as raw bytes and length-delimited
+    fields as (start, end) offsets into buf so nested messages are not copied.
+    """
+    pos = start
+    end = len(buf) if end is None else end
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        field_number, wire_type = key >> 3, key & 7
+        if wire_type == WIRE_VARINT:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == WIRE_FIXED64:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == WIRE_LENGTH_DELIMITED:
+            length, pos = read_varint(buf, pos)
+            value = (pos, pos + length)
+            pos += length
+        elif wire_type == WIRE_FIXED32:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError(f"Unsupported wire type {wire_type} at offset {pos}")
+        yield field_number, wire_type, value
+
+def decode_packed_varints(data):
+    """Decodes a buffer of concatenated varints into a uint64 array in one vectorized pass."""
+    raw = np.frombuffer(data, dtype=np.uint8)
+    if not raw.size:
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(raw < 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    # Position of every byte inside its varint gives the shift of its 7 payload bits
+    byte_positions = np.arange(raw.size) - np.repeat(starts, ends - starts + 1)
+    payload = (raw & 0x7f).astype(np.uint64) << (7 * byte_positions).astype(np.uint64)
+    return np.add.reduceat(payload, starts)
+
+def decode_zigzag(values):
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+def decode_value(buf, start, end):
+    for field_number, wire_type, value in iter_fields(buf, start, end):
+        if field_number == 1:
+            return bytes(buf[value[0]:value[1]]).decode('utf-8')
+        if field_number == 2:
+            return struct.unpack('<f', value)[0]
+        if field_number == 3:
+            return struct.unpack('<d', value)[0]
+        if field_number in (4, 8):
+            return zigzag(value)
+        if field_number in (5, 6, 7):
+            return value if field_number != 6 or value < 1 << 63 else value - (1 << 64)
+        if field_number == 9:
+            return bool(value)
+    return None
+
+def decode_field(buf, start, end):
+    field = {'name': None, 'type': None}
+    for field_number, _, value in iter_fields(buf, start, end):
+        if field_number == 1:
+            field['name'] = bytes(buf[value[0]:value[1]]).decode('utf-8')
+        elif field_number == 2:
+            field['type'] = FIELD_TYPES.get(value)
+    return field
+
+def decode_transform(buf, start, end):
+    transform = {'origin': ORIGIN_UPPER_LEFT, 'scale': (1.0, 1.0), 'translate': (0.0, 0.0)}
+    for field_number, _, value in iter_fields(buf, start, end):
+        if field_number == 1:
+            transform['origin'] = value
+        elif field_number in (2, 3):
+            pair = {1: 0.0, 2: 0.0}
+            for sub_number, _, sub_value in iter_fields(buf, *value):
+                if sub_number in pair:
+                    pair[sub_number] = struct.unpack('<d', sub_value)[0]
+            transform['scale' if field_number == 2 else 'translate'] = (pair[1], pair[2])
+    return transform
+
+class GeometryBuffers:
+    """Coordinates of all features in flat arrays.
+
+    coords holds every vertex as (x, y) rows, part_offsets indexes coords by part and
+    geometry_offsets indexes part_offsets by feature, so feature i owns the parts
+    geometry_offsets[i]:geometry_offsets[i + 1].
+    """
+
+    def __init__(self, geometry_type, coords, part_offsets, geometry_offsets):
+        self.geometry_type = geometry_type
+        self.coords = coords
+        self.part_offsets = part_offsets
+        self.geometry_offsets = geometry_offsets
+
+    def __len__(self):
+        return len(self.geometry_offsets) - 1
+
+    def parts(self, index):
+        first, last = self.geometry_offsets[index], self.geometry_offsets[index + 1]
+        return [self.coords[self.part_offsets[part]:self.part_offsets[part + 1]] for part in range(first, last)]
+
+    def geometry(self, index):
+        if self.geometry_offsets[index] == self.geometry_offsets[index + 1]:
+            return None
+        return PbfGeometry(self.geometry_type, self.parts(index))
+
+class PbfGeometry:
+    """Lightweight geometry built from GeometryBuffers, exposing __geo_interface__ like arcgis geometries."""
+
+    __slots__ = ('geometry_type', 'parts')
+
+    def __init__(self, geometry_type, parts):
+        self.geometry_type = geometry_type
+        self.parts = parts
+
+    @property
+    def __geo_interface__(self):
+        parts = [part.tolist() for part in self.parts]
+        if self.geometry_type == 'esriGeometryPoint':
+            return {'type': 'Point', 'coordinates': parts[0][0]}
+        if self.geometry_type == 'esriGeometryMultipoint':
+            return {'type': 'MultiPoint', 'coordinates': [point for part in parts for point in part]}
+        if self.geometry_type == 'esriGeometryPolyline':
+            if len(parts) == 1:
+                return {'type': 'LineString', 'coordinates': parts[0]}
+            return {'type': 'MultiLineString', 'coordinates': parts}
+        return {'type': 'Polygon', 'coordinates': parts}
+
+class FeatureResult:
+    """Decoded query page: field definitions, one column per field and the geometry buffers."""
+
+    def __init__(self, fields, columns, geometries, exceeded_transfer_limit):
+        self.fields = fields
+        self.columns = columns
+        self.geometries = geometries
+        self.exceeded_transfer_limit = exceeded_transfer_limit
+
+    def __len__(self):
+        return len(self.geometries)
+
+def decode_feature_collection(buf):
+    """Decodes a FeatureCollectionPBuffer holding a featureResult into a FeatureResult."""
+    buf = memoryview(buf)
+    for field_number, _, value in iter_fields(buf):
+        if field_number == 2:
+            for result_number, _, result_value in iter_fields(buf, *value):
+                if result_number == 1:
+                    return decode_feature_result(buf, *result_value)
+    raise ValueError("PBF response does not contain a feature result")
+
+def decode_feature_result(buf, start, end):
+    fields = []
+    transform = None
+    geometry_type = None
+    has_z = has_m = False
+    exceeded_transfer_limit = False
+    features = []
+    for field_number, _, value in iter_fields(buf, start, end):
+        if field_number == 7:
+            geometry_type = GEOMETRY_TYPES.get(value)
+        elif field_number == 9:
+            exceeded_transfer_limit = bool(value)
+        elif field_number == 10:
+            has_z = bool(value)
+        elif field_number == 11:
+            has_m = bool(value)
+        elif field_number == 12:
+            transform = decode_transform(buf, *value)
+        elif field_number == 13:
+            fields.append(decode_field(buf, *value))
+        elif field_number == 15:
+            features.append(value)
+
+    columns = [[None] * len(features) for _ in fields]
+    coord_chunks = []
+    part_lengths = []
+    parts_per_feature = np.zeros(len(features), dtype=np.int64)
+    for index, (feature_start, feature_end) in enumerate(features):
+        attribute_index = 0
+        for field_number, _, value in iter_fields(buf, feature_start, feature_end):
+            if field_number == 1:
+                if attribute_index < len(columns):
+                    columns[attribute_index][index] = decode_value(buf, *value)
+                attribute_index += 1
+            elif field_number == 2:
+                lengths = []
+                coords = None
+                for geometry_number, wire_type, geometry_value in iter_fields(buf, *value):
+                    if geometry_number == 2:
+                        if wire_type == WIRE_LENGTH_DELIMITED:
+                            lengths.extend(decode_packed_varints(buf[geometry_value[0]:geometry_value[1]]).tolist())
+                        else:
+                            lengths.append(geometry_value)
+                    elif geometry_number == 3:
+                        coords = buf[geometry_value[0]:geometry_value[1]]
+                if coords is None:
+                    continue
+                coord_chunks.append(coords)
+                # Points carry no lengths, their single part spans the whole geometry
+                part_lengths.extend(lengths or [None])
+                parts_per_feature[index] = len(lengths) or 1
+
+    dimensions = 2 + has_z + has_m
+    geometries = build_geometry_buffers(
+        geometry_type, coord_chunks, part_lengths, parts_per_feature, dimensions, transform
+    )
+    return FeatureResult(fields, columns, geometries, exceeded_transfer_limit)
+
+def build_geometry_buffers(geometry_type, coord_chunks, part_lengths, parts_per_feature, dimensions, transform):
+    # Every geometry's coordinates are zigzag deltas from its own first vertex, so they are decoded
+    # together and the running sum is restarted at each geometry boundary.
+    values = [decode_zigzag(decode_packed_varints(bytes(chunk))) for chunk in coord_chunks]
+    vertex_counts = np.array([len(chunk) // dimensions for chunk in values], dtype=np.int64)
+    if values:
+        deltas = np.concatenate(values).reshape(-1, dimensions)[:, :2]
+    else:
+        deltas = np.zeros((0, 2), dtype=np.int64)
+    quantized = np.cumsum(deltas, axis=0)
+    geometry_starts = np.concatenate([[0], np.cumsum(vertex_counts)[:-1]]) if len(vertex_counts) else np.zeros(0, dtype=np.int64)
+    if len(vertex_counts):
+        base = np.repeat(quantized[geometry_starts] - deltas[geometry_starts], vertex_counts, axis=0)
+        quantized = quantized - base
+
+    coords = quantized.astype(np.float64)
+    if transform:
+        coords[:, 0] = transform['translate'][0] + coords[:, 0] * transform['scale'][0]
+        if transform['origin'] == ORIGIN_UPPER_LEFT:
+            coords[:, 1] = transform['translate'][1] - coords[:, 1] * transform['scale'][1]
+        else:
+            coords[:, 1] = transform['translate'][1] + coords[:, 1] * transform['scale'][1]
+
+    # Parts without an explicit length (points) span their whole geometry
+    lengths = []
+    chunk_index = 0
+    part_index = 0
+    for part_count in parts_per_feature:
+        chunk_parts = part_lengths[part_index:part_index + part_count]
+        if part_count:
+            lengths.extend(
+                vertex_counts[chunk_index] if length is None else length for length in chunk_parts
+            )
+            chunk_index += 1
+        part_index += part_count
+    part_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    part_offsets[1:] = np.cumsum(lengths)
+    geometry_offsets = np.zeros(len(parts_per_feature) + 1, dtype=np.int64)
+    geometry_offsets[1:] = np.cumsum(parts_per_feature)
+    return GeometryBuffers(geometry_type, coords, part_offsets, geometry_offsets)
+
+def column_to_series(field, values):
+    if field['type'] in INTEGER_FIELD_TYPES:
+        if any(value is None for value in values):
+            return pd.Series(values, dtype='float64')
+        return pd.Series(values, dtype='int64')
+    if field['type'] in FLOAT_FIELD_TYPES:
+        return pd.Series(values, dtype='float64')
+    if field['type'] == 'esriFieldTypeDate':
+        return pd.to_datetime(pd.Series(values, dtype='float64'), unit='ms', errors='coerce')
+    return pd.Series(values, dtype='object')
+
+def feature_results_to_dataframe(results):
+    """Concatenates decoded pages into a DataFrame shaped like FeatureSet.sdf, with geometries in SHAPE."""
+    if not results:
+        return pd.DataFrame()
+    fields = results[0].fields
+    data = {}
+    for index, field in enumerate(fields):
+        values = [value for result in results for value in result.columns[index]]
+        data[field['name']] = column_to_series(field, values)
+    data['SHAPE'] = pd.Series(
+        [result.geometries.geometry(i) for result in results for i in range(len(result))], dtype='object'
+    )
+    return pd.DataFrame(data)
@@ -0,0 +1,227 @@
+"""Runs search_servers -> fetch_metadata -> search_relevant_layers -> upload -> export_tiles in one process.
+
+Each stage's output is handed to the next one in memory (and still written to its usual file).
+A stage is skipped when the fingerprint of its inputs and code matches the last successful run
+recorded in pipeline_state.json, and the crawl only visits servers it hasn't crawled yet when
+just the server list changed.
+
+    python pipeline.py                  # run whatever is out of date
+    python pipeline.py --dry-run        # only report what would run
+    python pipeline.py --force fetch_metadata,upload
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from instrumentation import metrics
+
+
+STATE_FILE_PATH = 'pipeline_state.json'
+SERVERS_FILE_PATH = 'servers.txt'
+METADATA_FILE_PATH = 'all_server_responses.json'
+ADDED_LAYERS_FILE_PATH = 'added_layers.json'
+TILES_FILE_PATH = 'utility_layers.mbtiles'
+
+STAGES = ['search_servers', 'fetch_metadata', 'search_relevant_layers', 'upload', 'export_tiles']
+
+# Source files whose changes invalidate a stage's previous output
+STAGE_CODE = {
+    'search_servers': ['search_servers.py'],
+    'fetch_metadata': ['fetch_metadata.py'],
+    'search_relevant_layers': ['search_relevant_layers.py', 'mirror_layers.py'],
+    'upload': ['upload_to_cockroachdb.py', 'async_db_writer.py', 'feature_download.py', 'pbf_decoder.py', 'shadow_schema.py'],
+    'export_tiles': ['vector_tiles.py', 'mvt_encoder.py']
+}
+
+def fingerprint(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(json.dumps(part, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+def code_fingerprint(stage):
+    digest = hashlib.sha256()
+    for path in STAGE_CODE[stage]:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def load_json(path, default=None):
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_json(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=4)
+
+class Pipeline:
+    def __init__(self, force=(), dry_run=False):
+        self.force = set(force)
+        self.dry_run = dry_run
+        self.state = load_json(STATE_FILE_PATH, {})
+
+    def is_fresh(self, stage, inputs_fingerprint, output_path):
+        if stage in self.force or not os.path.exists(output_path):
+            return False
+        return self.state.get(stage, {}).get('fingerprint') == inputs_fingerprint
+
+    def record(self, stage, inputs_fingerprint, **extra):
+        self.state[stage] = dict(extra, fingerprint=inputs_fingerprint)
+        save_json(STATE_FILE_PATH, self.state)
+
+    def skip(self, stage):
+        metrics.increment(f"{stage}_skipped")
+        logging.info(f"Stage {stage} is up to date, skipping")
+
+    def search_servers(self):
+        inputs = fingerprint(code_fingerprint('search_servers'))
+        if self.is_fresh('search_servers', inputs, SERVERS_FILE_PATH):
+            self.skip('search_servers')
+            return None
+        if self.dry_run:
+            logging.info("Would run search_servers")
+            return None
+        from search_servers import find_servers
+
+        with metrics.span('search_servers'):
+            servers = sorted(find_servers())
+        with open(SERVERS_FILE_PATH, 'w') as f:
+            for server in servers:
+                f.write(server + '\n')
+        self.record('search_servers', inputs)
+        return servers
+
+    def fetch_metadata(self, servers):
+        from fetch_metadata import crawl_servers, normalize_url, read_servers
+
+        servers = [normalize_url(server) for server in servers] if servers is not None else read_servers(SERVERS_FILE_PATH)
+        servers = list(dict.fromkeys(servers))
+        code = code_fingerprint('fetch_metadata')
+        inputs = fingerprint(code, servers)
+        previous_results = load_json(METADATA_FILE_PATH, {})
+        if self.is_fresh('fetch_metadata', inputs, METADATA_FILE_PATH):
+            self.skip('fetch_metadata')
+            return previous_results
+
+        # With unchanged crawler code only servers missing from the last crawl have to be visited
+        previous = self.state.get('fetch_metadata', {})
+        crawled = set(previous.get('servers', [])) if previous.get('code') == code and 'fetch_metadata' not in self.force else set()
+        pending = [server for server in servers if server not in crawled]
+        logging.info(f"Crawling {len(pending)} of {len(servers)} servers")
+        if self.dry_run:
+            return previous_results
+
+        failed_servers = []
+        with metrics.span('fetch_metadata'):
+            new_results = asyncio.run(crawl_servers(pending, failed_servers))
+        all_results = {}
+        for server in servers:
+            results = previous_results.get(server) if server in crawled else new_results.get(server)
+            if results:
+                all_results[server] = results
+        save_json(METADATA_FILE_PATH, all_results)
+
+        # Failed servers stay pending: they are left out of the recorded list, and the stage
+        # fingerprint then no longer matches, so the next run crawls just those servers again
+        finished = [server for server in servers if server not in failed_servers]
+        if failed_servers:
+            logging.warning(f"{len(failed_servers)} servers failed and will be crawled again on the next run")
+        self.record('fetch_metadata', fingerprint(code, finished), code=code, servers=finished)
+        return all_results
+
+    def search_relevant_layers(self, services_metadata):
+        import search_relevant_layers
+
+        inputs = fingerprint(
+            code_fingerprint('search_relevant_layers'),
+            services_metadata,
+            search_relevant_layers.utility_keywords,
+            search_relevant_layers.desired_geometry_types
+        )
+        if self.is_fresh('search_relevant_layers', inputs, ADDED_LAYERS_FILE_PATH):
+            self.skip('search_relevant_layers')
+            return load_json(ADDED_LAYERS_FILE_PATH, [])
+        if self.dry_run:
+            logging.info("Would run search_relevant_layers")
+            return load_json(ADDED_LAYERS_FILE_PATH, [])
+
+        matching_services = search_relevant_layers.find_matching_layers(
+            list(search_relevant_layers.iter_layers(services_metadata))
+        )
+        layers_for_webmap = search_relevant_layers.build_added_layers(
+            search_relevant_layers.dedup_mirror_layers(matching_services)
+        )
+        save_json(ADDED_LAYERS_FILE_PATH, layers_for_webmap)
+        self.record('search_relevant_layers', inputs)
+        return layers_for_webmap
+
+    def upload(self, layers_for_webmap):
+        """Uploads the layers if out of date and returns True if anything was written."""
+        inputs = fingerprint(code_fingerprint('upload'), layers_for_webmap)
+        if self.is_fresh('upload', inputs, ADDED_LAYERS_FILE_PATH):
+            self.skip('upload')
+            return False
+        if self.dry_run:
+            logging.info(f"Would upload {len(layers_for_webmap)} layers")
+            return False
+        from upload_to_cockroachdb import store_layers
+
+        with metrics.span('upload'):
+            failed_layers = store_layers(layers_for_webmap)
+        if failed_layers:
+            # Not recorded, so the next run uploads again instead of skipping the failed layers
+            logging.warning(f"{len(failed_layers)} layers failed to upload and will be uploaded again on the next run")
+            return True
+        self.record('upload', inputs)
+        return True
+
+    def export_tiles(self, layers_for_webmap, uploaded=False):
+        # Layers are re-encoded only when their rows changed, this just avoids reading them back after a skipped upload
+        inputs = fingerprint(code_fingerprint('export_tiles'), self.state.get('upload', {}).get('fingerprint'))
+        if not uploaded and self.is_fresh('export_tiles', inputs, TILES_FILE_PATH):
+            self.skip('export_tiles')
+            return
+        if self.dry_run:
+            logging.info(f"Would export tiles for {len(layers_for_webmap)} layers")
+            return
+        from vector_tiles import export_schema, export_tiles, layer_table_names
+
+        with metrics.span('export_tiles'):
+            asyncio.run(export_tiles(layer_table_names(layers_for_webmap), TILES_FILE_PATH, export_schema()))
+        self.record('export_tiles', inputs)
+
+    def run(self, stages=STAGES):
+        servers = self.search_servers() if 'search_servers' in stages else None
+        services_metadata = load_json(METADATA_FILE_PATH, {})
+        if 'fetch_metadata' in stages:
+            services_metadata = self.fetch_metadata(servers)
+        layers_for_webmap = load_json(ADDED_LAYERS_FILE_PATH, [])
+        if 'search_relevant_layers' in stages:
+            layers_for_webmap = self.search_relevant_layers(services_metadata)
+        uploaded = self.upload(layers_for_webmap) if 'upload' in stages else False
+        if 'export_tiles' in stages:
+            self.export_tiles(layers_for_webmap, uploaded)
+        if not self.dry_run:
+            metrics.write_report('pipeline')
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stages', default=','.join(STAGES), help="Comma-separated stages to consider")
+    parser.add_argument('--force', default='', help="Comma-separated stages to re-run even if up to date")
+    parser.add_argument('--dry-run', action='store_true', help="Only report which stages would run")
+    args = parser.parse_args()
+
+    stages = [stage for stage in args.stages.split(',') if stage]
+    force = [stage for stage in args.force.split(',') if stage]
+    for stage in stages + force:
+        if stage not in STAGES:
+            parser.error(f"Unknown stage {stage}, expected one of {', '.join(STAGES)}")
+    Pipeline(force=force, dry_run=args.dry_run).run(stages)
+
+if __name__ == '__main__':
+    main()
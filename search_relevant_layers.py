@@ -1,8 +1,10 @@
 import json
 import re
+import argparse
 from tqdm import tqdm
 from concurrent.futures import ThreadPoolExecutor, as_completed
-import osmnx as ox
+from instrumentation import metrics
+from mirror_layers import dedup_mirror_layers
 
 
 # Example list of utility-related keywords
@@ -45,42 +47,75 @@ def search_metadata(service, keywords, geometry_types):
         return service
     return None
 
-# Load metadata from file
-with open("all_server_responses.json", 'r') as f:
-    services_metadata = json.load(f)
-
-# Define the place of interest
-county_name = "Los Angeles County, California, USA"
-
-# Get the boundary of Los Angeles County
-county_gdf = ox.geocode_to_gdf(county_name)
-county_polygon = county_gdf.loc[0, 'geometry']
-
-# Use tqdm to display progress when loading metadata
-print("Loading metadata...")
-
-# Search the downloaded metadata for utility-related keywords and filter by geometry type and extent
-matching_services = []
-with ThreadPoolExecutor(max_workers=10) as executor:
-    futures = [executor.submit(search_metadata, service, utility_keywords, desired_geometry_types) for service in services_metadata]
-    for future in tqdm(as_completed(futures), total=len(futures), desc="Searching metadata"):
-        result = future.result()
-        if result:
-            matching_services.append(result)
-
-# Use tqdm to display progress when saving layers
-print("Saving matching layers...")
-layers_for_webmap = []
-for service in tqdm(matching_services, desc="Saving layers"):
-    layer_info = {
-        'title': service['layer_name'],
-        'url': service['url'],
-        'type': 'FeatureLayer'
-    }
-    layers_for_webmap.append(layer_info)
-
-# Save the list of added layers with URLs
-with open('added_layers.json', 'w') as f:
-    json.dump(layers_for_webmap, f, indent=4)
-
-print("Added layers saved to added_layers.json")
+# Flatten the nested server/folder/service output of fetch_metadata.py into a list of layers
+def iter_layers(services_metadata):
+    if isinstance(services_metadata, list):
+        yield from services_metadata
+        return
+
+    def walk(folder):
+        for service in folder.get('services', []):
+            yield from service.get('layers', [])
+        for subfolder in folder.get('folders', []) + folder.get('subfolders', []):
+            yield from walk(subfolder)
+
+    for server_results in services_metadata.values():
+        yield from walk(server_results)
+
+# Search the layers for utility-related keywords and filter by geometry type
+def find_matching_layers(layers, keywords=utility_keywords, geometry_types=desired_geometry_types):
+    matching_services = []
+    with metrics.span('search'), ThreadPoolExecutor(max_workers=10) as executor:
+        futures = [executor.submit(search_metadata, service, keywords, geometry_types) for service in layers]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Searching metadata"):
+            result = future.result()
+            if result:
+                matching_services.append(result)
+    metrics.increment('layers_searched', len(futures))
+    metrics.increment('layers_matched', len(matching_services))
+    return matching_services
+
+def build_added_layers(matching_services):
+    layers_for_webmap = []
+    for service in tqdm(matching_services, desc="Saving layers"):
+        layer_info = {
+            'title': service['layer_name'],
+            'url': service['url'],
+            'type': 'FeatureLayer'
+        }
+        if service.get('fingerprint'):
+            layer_info['fingerprint'] = service['fingerprint']
+        if service.get('mirrors'):
+            layer_info['mirrors'] = service['mirrors']
+        layers_for_webmap.append(layer_info)
+    return layers_for_webmap
+
+def main():
+    parser = argparse.ArgumentParser(description="Find utility layers in all_server_responses.json and write added_layers.json")
+    parser.parse_args()
+
+    # Load metadata from file
+    with open("all_server_responses.json", 'r') as f:
+        services_metadata = json.load(f)
+
+    # Use tqdm to display progress when loading metadata
+    print("Loading metadata...")
+
+    matching_services = find_matching_layers(list(iter_layers(services_metadata)))
+
+    # Keep one copy of layers published on several servers or as both MapServer and FeatureServer
+    matching_services = dedup_mirror_layers(matching_services)
+
+    # Use tqdm to display progress when saving layers
+    print("Saving matching layers...")
+    layers_for_webmap = build_added_layers(matching_services)
+
+    # Save the list of added layers with URLs
+    with open('added_layers.json', 'w') as f:
+        json.dump(layers_for_webmap, f, indent=4)
+
+    print("Added layers saved to added_layers.json")
+    metrics.write_report('search_relevant_layers')
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,34 @@
-import osmnx as ox
-import geopandas as gpd
-from arcgis.gis import GIS
-from arcgis.geocoding import reverse_geocode
 from urllib.parse import urlparse, urlunparse
+import argparse
 import os
 
 
-# Initialize the GIS
-gis = GIS("https://www.arcgis.com", os.getenv('USERNAME'), os.getenv('PASSWORD'))
-
 # Define the place of interest
 county_name = "Los Angeles County, California, USA"
 
-# Get the boundary of Los Angeles County
-county_gdf = ox.geocode_to_gdf(county_name)
-county_polygon = county_gdf.loc[0, 'geometry']
+# Additional searches for broader terms
+additional_search_terms = [
+    "Los Angeles County, California, USA",
+    "California, USA",
+    "usa gas pipeline",
+    "usa electricity transmission lines"
+]
+
+def get_place_names():
+    """Returns the names of the cities and towns within Los Angeles County."""
+    import osmnx as ox
+
+    # Get the boundary of Los Angeles County
+    county_gdf = ox.geocode_to_gdf(county_name)
+    county_polygon = county_gdf.loc[0, 'geometry']
 
-# Download place boundaries within Los Angeles County including cities, towns, villages, and hamlets
-tags = {'place': ['city', 'town']}
-places_gdf = ox.features_from_polygon(county_polygon, tags=tags)
+    # Download place boundaries within Los Angeles County including cities, towns, villages, and hamlets
+    tags = {'place': ['city', 'town']}
+    places_gdf = ox.features_from_polygon(county_polygon, tags=tags)
 
-# Ensure only valid strings are considered for place names and filter by geometry within the county polygon
-places_gdf = places_gdf[places_gdf.geometry.within(county_polygon)]
-place_names_script = set([name for name in places_gdf['name'] if isinstance(name, str)])
+    # Ensure only valid strings are considered for place names and filter by geometry within the county polygon
+    places_gdf = places_gdf[places_gdf.geometry.within(county_polygon)]
+    return set([name for name in places_gdf['name'] if isinstance(name, str)])
 
 def get_root_url(service_url):
     """Extracts the root URL from a given service URL and ensures no double slashes."""
@@ -37,7 +43,7 @@ def get_root_url(service_url):
     except (ValueError, IndexError):
         return urlunparse(parsed_url._replace(path='/'.join(filter(None, parsed_url.path.split('/')))))
 
-def search_for_servers(search_terms):
+def search_for_servers(gis, search_terms):
     """Searches for servers based on a list of search terms."""
     servers = set()
     for term in search_terms:
@@ -56,27 +62,35 @@ def search_for_servers(search_terms):
             print(f"Error searching for {term}: {str(e)}")
     return servers
 
-# Perform individual searches for each place name
-unique_servers = search_for_servers(place_names_script)
+def find_servers():
+    """Searches ArcGIS Online for root servers publishing data about Los Angeles County."""
+    from arcgis.gis import GIS
 
-# Additional searches for broader terms
-additional_search_terms = [
-    "Los Angeles County, California, USA",
-    "California, USA",
-    "usa gas pipeline",
-    "usa electricity transmission lines"
-]
+    # Initialize the GIS
+    gis = GIS("https://www.arcgis.com", os.getenv('USERNAME'), os.getenv('PASSWORD'))
+
+    # Perform individual searches for each place name
+    unique_servers = search_for_servers(gis, get_place_names())
+    unique_servers.update(search_for_servers(gis, additional_search_terms))
+    return unique_servers
 
-unique_servers.update(search_for_servers(additional_search_terms))
+def main():
+    parser = argparse.ArgumentParser(description="Search ArcGIS Online for servers and write servers.txt")
+    parser.parse_args()
 
-# Print or process the unique servers
-print("Unique Root Servers Found:")
-print(len(unique_servers))
-for server in unique_servers:
-    print(server)
+    unique_servers = find_servers()
 
-# Save unique servers to a file
-output_file = 'servers.txt'
-with open(output_file, 'w') as f:
+    # Print or process the unique servers
+    print("Unique Root Servers Found:")
+    print(len(unique_servers))
     for server in unique_servers:
-        f.write(server + '\n')
+        print(server)
+
+    # Save unique servers to a file
+    output_file = 'servers.txt'
+    with open(output_file, 'w') as f:
+        for server in unique_servers:
+            f.write(server + '\n')
+
+if __name__ == '__main__':
+    main()
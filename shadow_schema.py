@@ -0,0 +1,57 @@
+import os
+import logging
+from datetime import datetime, timezone
+from instrumentation import metrics
+
+
+# Schema readers query, each refresh is loaded next to it and swapped in when complete
+LIVE_SCHEMA = os.getenv('DB_LIVE_SCHEMA', 'utility_layers')
+
+# Number of previous live schemas kept after a swap so a refresh can be rolled back by renaming
+KEEP_OLD_VERSIONS = int(os.getenv('DB_KEEP_OLD_VERSIONS', '1'))
+
+def shadow_prefix(live_schema=LIVE_SCHEMA):
+    return f"{live_schema}_v"
+
+def old_prefix(live_schema=LIVE_SCHEMA):
+    return f"{live_schema}_old_"
+
+def version_suffix():
+    return datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')
+
+async def list_schemas(pool, prefix):
+    rows = await pool.fetch(
+        "SELECT schema_name FROM information_schema.schemata WHERE left(schema_name, length($1)) = $1", prefix
+    )
+    return sorted(row['schema_name'] for row in rows)
+
+async def create_shadow_schema(pool, live_schema=LIVE_SCHEMA):
+    schema = f"{shadow_prefix(live_schema)}{version_suffix()}"
+    await pool.execute(f'CREATE SCHEMA "{schema}"')
+    logging.info(f"Created shadow schema {schema}")
+    return schema
+
+async def swap_schema(pool, shadow_schema, live_schema=LIVE_SCHEMA):
+    """Makes the shadow schema live in one transaction; the previous live schema is kept as an old version."""
+    with metrics.span('schema_swap'):
+        async with pool.acquire() as connection:
+            async with connection.transaction():
+                live_exists = await connection.fetchval(
+                    "SELECT EXISTS (SELECT 1 FROM information_schema.schemata WHERE schema_name = $1)", live_schema
+                )
+                if live_exists:
+                    await connection.execute(
+                        f'ALTER SCHEMA "{live_schema}" RENAME TO "{old_prefix(live_schema)}{version_suffix()}"'
+                    )
+                await connection.execute(f'ALTER SCHEMA "{shadow_schema}" RENAME TO "{live_schema}"')
+    logging.info(f"Swapped {shadow_schema} in as {live_schema}")
+
+async def collect_garbage(pool, live_schema=LIVE_SCHEMA, keep=KEEP_OLD_VERSIONS, active_shadow=None):
+    """Drops old live schemas beyond the newest `keep`, and shadow schemas left behind by failed loads."""
+    old_schemas = await list_schemas(pool, old_prefix(live_schema))
+    abandoned = [schema for schema in await list_schemas(pool, shadow_prefix(live_schema)) if schema != active_shadow]
+    expired = old_schemas[:-keep] if keep > 0 else old_schemas
+    for schema in expired + abandoned:
+        await pool.execute(f'DROP SCHEMA IF EXISTS "{schema}" CASCADE')
+        metrics.increment('schemas_dropped')
+        logging.info(f"Dropped schema {schema}")
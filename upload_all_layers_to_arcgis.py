@@ -1,70 +1,124 @@
 import json
+import argparse
 from tqdm import tqdm
-from arcgis.gis import GIS
-from arcgis.geometry import Polygon
-from arcgis.features import FeatureLayer
-from arcgis.mapping import WebMap
-from arcgis.geometry.filters import intersects
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
-import osmnx as ox
-
-
-# Load the list of layers from the JSON file
-with open('added_layers.json', 'r') as f:
-    layers_for_webmap = json.load(f)
-
-# Define the place of interest
-county_name = "Los Angeles County, California, USA"
-
-# Get the boundary of Los Angeles County
-county_gdf = ox.geocode_to_gdf(county_name)
-county_polygon = county_gdf.loc[0, 'geometry']
-extent_polygon = Polygon(county_polygon.__geo_interface__)
-
-# Transform the list layers_for_webmap into a FeatureLayer list
-print("Transforming to FeatureLayer list...")
-feature_layers = []
-for layer in tqdm(layers_for_webmap, desc="Creating FeatureLayer objects"):
-    feature_layer = FeatureLayer(layer['url'])
-    feature_layers.append(feature_layer)
-
-# Now `feature_layers` contains the FeatureLayer objects
-print("Feature Layers:")
-for layer in feature_layers:
-    print(layer)
-
-# Replace the placeholders with your own variables
-username = os.getenv('USERNAME')
-password = os.getenv('PASSWORD')
-
-# Initialize the GIS
-gis = GIS("https://www.arcgis.com", username, password)
-
-# Check if the WebMap already exists
-existing_maps = gis.content.search(query=f'title:{county_name}', item_type='Web Map')
-if existing_maps and existing_maps[0].owner == gis.users.me.username:
-    webmap_item = existing_maps[0]
-    webmap_obj = WebMap(webmap_item)
-    # Remove all existing layers
-    webmap_obj.remove_layers()
-else:
-    webmap_obj = WebMap()
-
-# Query and display features within the polygon
-for layer in tqdm(feature_layers, desc="Querying and adding layers"):
-    try:
-        result = layer.query(geometry_filter=intersects(extent_polygon))
-        if result.features:
-            webmap_obj.add_layer(layer)
+
+
+# Number of layers validated in parallel
+MAX_WORKERS = int(os.getenv('VALIDATION_WORKERS', '16'))
+
+def normalize_layer_url(url):
+    """Normalizes a layer URL so layers in the web map and added_layers.json compare equal."""
+    return url.strip().rstrip('/').lower() if url else ''
+
+def layer_intersects_extent(layer_info, extent_polygon):
+    """Returns True if the layer has at least one feature inside the extent.
+
+    Only the feature count is requested, so no geometries or attributes are transferred.
+    """
+    from arcgis.features import FeatureLayer
+    from arcgis.geometry.filters import intersects
+
+    feature_layer = FeatureLayer(layer_info['url'])
+    count = feature_layer.query(
+        geometry_filter=intersects(extent_polygon),
+        return_count_only=True
+    )
+    return count > 0
+
+def validate_layers(layers, extent_polygon):
+    """Checks the layers against the extent concurrently and returns those that have features inside it."""
+    valid_layers = []
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(layer_intersects_extent, layer, extent_polygon): layer for layer in layers}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Validating layers"):
+            layer = futures[future]
+            try:
+                if future.result():
+                    valid_layers.append(layer)
+                else:
+                    print(f"No features found in layer {layer['title']}")
+            except Exception as e:
+                print(f"Error querying layer {layer['title']}: {e}")
+    return valid_layers
+
+def main():
+    parser = argparse.ArgumentParser(description="Add the layers in added_layers.json to the web map")
+    parser.parse_args()
+
+    import osmnx as ox
+    from arcgis.gis import GIS
+    from arcgis.geometry import Polygon
+    from arcgis.features import FeatureLayer
+    from arcgis.mapping import WebMap
+
+    # Load the list of layers from the JSON file
+    with open('added_layers.json', 'r') as f:
+        layers_for_webmap = json.load(f)
+
+    # Define the place of interest
+    county_name = "Los Angeles County, California, USA"
+
+    # Get the boundary of Los Angeles County
+    county_gdf = ox.geocode_to_gdf(county_name)
+    county_polygon = county_gdf.loc[0, 'geometry']
+    extent_polygon = Polygon(county_polygon.__geo_interface__)
+
+    # Replace the placeholders with your own variables
+    username = os.getenv('USERNAME')
+    password = os.getenv('PASSWORD')
+
+    # Initialize the GIS
+    gis = GIS("https://www.arcgis.com", username, password)
+
+    # Check if the WebMap already exists
+    existing_maps = gis.content.search(query=f'title:{county_name}', item_type='Web Map')
+    map_exists = bool(existing_maps) and existing_maps[0].owner == gis.users.me.username
+    if map_exists:
+        webmap_item = existing_maps[0]
+        webmap_obj = WebMap(webmap_item)
+    else:
+        webmap_obj = WebMap()
+
+    # Index the layers currently in the map by URL
+    current_layers = {}
+    for layer in webmap_obj.layers:
+        url = normalize_layer_url(layer.get('url'))
+        if url:
+            current_layers[url] = layer
+
+    # Deduplicate the desired layers by URL, keeping the first occurrence
+    desired_layers = {}
+    for layer in layers_for_webmap:
+        url = normalize_layer_url(layer['url'])
+        if url and url not in desired_layers:
+            desired_layers[url] = layer
+
+    # Layers already in the map were validated on a previous run, only new ones are queried
+    new_layers = [layer for url, layer in desired_layers.items() if url not in current_layers]
+    stale_urls = [url for url in current_layers if url not in desired_layers]
+    print(f"{len(desired_layers)} desired layers: {len(new_layers)} new, {len(stale_urls)} to remove, "
+          f"{len(desired_layers) - len(new_layers)} unchanged")
+
+    layers_to_add = validate_layers(new_layers, extent_polygon)
+
+    for url in tqdm(stale_urls, desc="Removing layers"):
+        webmap_obj.remove_layer(current_layers[url])
+
+    for layer in tqdm(layers_to_add, desc="Adding layers"):
+        webmap_obj.add_layer(FeatureLayer(layer['url']), options={'title': layer['title']})
+
+    # Save the WebMap
+    if map_exists:
+        if layers_to_add or stale_urls:
+            webmap_obj.update({'tags': 'utility, layers', 'snippet': 'Updated WebMap containing utility layers'})
         else:
-            print(f"No features found in layer {layer.properties['name']}")
-    except Exception as e:
-        print(f"Error querying layer {layer.properties['name']}: {e}")
+            print("WebMap is already up to date")
+    else:
+        webmap_item = webmap_obj.save({'title': county_name, 'tags': 'utility, layers', 'snippet': 'WebMap containing utility layers'})
 
-# Save the WebMap
-if existing_maps and existing_maps[0].owner == gis.users.me.username:
-    webmap_item = webmap_obj.update({'tags': 'utility, layers', 'snippet': 'Updated WebMap containing utility layers'})
-else:
-    webmap_item = webmap_obj.save({'title': county_name, 'tags': 'utility, layers', 'snippet': 'WebMap containing utility layers'})
+    print(f"WebMap created or updated with ID: {webmap_item.id}")
 
-print(f"WebMap created or updated with ID: {webmap_item.id}")
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,30 @@
 import os
-import psycopg2
+import asyncio
+import argparse
 import json
 import pandas as pd
-import geopandas as gpd
-from arcgis.features import FeatureLayer
 import re
+import time
+import uuid
 import logging
+from instrumentation import metrics
 
-logging.basicConfig(level=logging.INFO)
+# 'async' streams writes through async_db_writer.py, 'sync' uses the single psycopg2 cursor
+DB_WRITER = os.getenv('DB_WRITER', 'async')
+
+# 'in_place' upserts into the live tables, 'shadow' loads a fresh versioned schema and swaps it in (async writer only)
+DB_LOAD_MODE = os.getenv('DB_LOAD_MODE', 'in_place')
+
+# Table holding a new random version for a layer table every time it is written, so vector_tiles.py
+# can tell which tables changed without reading them
+VERSIONS_TABLE = 'layer_versions'
+
+# Number of layers being downloaded or written at the same time, which bounds the downloaded layers held in memory
+DOWNLOAD_CONCURRENCY = int(os.getenv('DOWNLOAD_CONCURRENCY', '4'))
 
 def connect_to_database():
+    import psycopg2
+
     conn = psycopg2.connect(
         host=os.getenv('COCKROACH_DB_HOST'),
         database=os.getenv('COCKROACH_DB_DATABASE'),
@@ -19,8 +34,6 @@ def connect_to_database():
     )
     return conn
 
-conn = connect_to_database()
-cur = conn.cursor()
 
 def sanitize_table_name(name):
     name = re.sub(r'\W+', '_', name)
@@ -32,35 +45,57 @@ def check_table_exists(table_name):
     cur.execute(f"SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_name = '{table_name}');")
     return cur.fetchone()[0]
 
-def create_table_from_dataframe(table_name, dataframe):
-    columns = []
+def column_types(dataframe):
+    column_types = []
     
     for column_name in dataframe.columns:
-        escaped_column_name = f'"{column_name}"'
         if column_name.lower() == 'shape':
-            columns.append(f"{escaped_column_name} JSONB")
+            column_types.append((column_name, 'JSONB'))
         elif dataframe[column_name].dtype == 'int64':
-            columns.append(f"{escaped_column_name} INTEGER")
+            column_types.append((column_name, 'INTEGER'))
         elif dataframe[column_name].dtype == 'float64':
-            columns.append(f"{escaped_column_name} FLOAT")
+            column_types.append((column_name, 'FLOAT'))
         elif pd.api.types.is_datetime64_any_dtype(dataframe[column_name]):
-            columns.append(f"{escaped_column_name} TIMESTAMP")
+            column_types.append((column_name, 'TIMESTAMP'))
         else:
-            columns.append(f"{escaped_column_name} TEXT")
+            column_types.append((column_name, 'TEXT'))
+    
+    return column_types
+
+def build_create_table_query(table_name, dataframe, unique=True):
+    columns = [f'"{column_name}" {column_type}' for column_name, column_type in column_types(dataframe)]
     
     if not columns:
         raise ValueError("No columns defined for the table.")
     
     columns_query = ", ".join(columns)
-    create_table_query = f"""
+    unique_constraint = f',\n        UNIQUE ("{dataframe.columns[0]}")' if unique else ''
+    return f"""
     CREATE TABLE IF NOT EXISTS {table_name} (
         id SERIAL PRIMARY KEY,
         {columns_query},
         srid INTEGER,
-        drawing_info JSONB,
-        UNIQUE ("{dataframe.columns[0]}")
+        drawing_info JSONB{unique_constraint}
     )
     """
+
+def build_versions_table_query(table_name):
+    return f"CREATE TABLE IF NOT EXISTS {table_name} (table_name TEXT PRIMARY KEY, version TEXT NOT NULL)"
+
+def new_table_version():
+    return uuid.uuid4().hex
+
+def mark_table_changed(table_name):
+    cur.execute(build_versions_table_query(VERSIONS_TABLE))
+    cur.execute(
+        f"INSERT INTO {VERSIONS_TABLE} (table_name, version) VALUES (%s, %s) "
+        "ON CONFLICT (table_name) DO UPDATE SET version = EXCLUDED.version",
+        (table_name, new_table_version())
+    )
+    conn.commit()
+
+def create_table_from_dataframe(table_name, dataframe):
+    create_table_query = build_create_table_query(table_name, dataframe)
     logging.info(f"Creating table with query: {create_table_query}")
     cur.execute(create_table_query)
     conn.commit()
@@ -83,12 +118,18 @@ def validate_and_convert_dataframe(dataframe):
             dataframe[column] = pd.to_datetime(dataframe[column], errors='coerce')
     return dataframe
 
+def prepare_dataframe(dataframe):
+    with metrics.span('transform'):
+        dataframe = validate_and_convert_dataframe(dataframe)
+
+        if 'SHAPE' in dataframe.columns:
+            dataframe['SHAPE'] = dataframe['SHAPE'].apply(convert_geometry_to_json)
+    return dataframe
+
 def insert_dataframe_to_supabase(table_name, dataframe, srid, drawing_info):
-    dataframe = validate_and_convert_dataframe(dataframe)
+    import psycopg2
 
-    if 'SHAPE' in dataframe.columns:
-        dataframe['SHAPE'] = dataframe['SHAPE'].apply(convert_geometry_to_json)
-    
+    dataframe = prepare_dataframe(dataframe)
     drawing_info_dict = dict(drawing_info)
     
     for _, row in dataframe.iterrows():
@@ -103,49 +144,164 @@ def insert_dataframe_to_supabase(table_name, dataframe, srid, drawing_info):
         VALUES ({values}) 
         ON CONFLICT ("{dataframe.columns[0]}") DO UPDATE SET {update_set}
         """
-        logging.info(f"Inserting row with query: {insert_query}")
+        logging.debug("Inserting row with query: %s", insert_query)
         try:
             cur.execute(insert_query, tuple(row))
+            metrics.increment('rows_written')
         except psycopg2.Error as e:
+            metrics.increment('row_errors')
             logging.error(f"Error inserting row: {e}")
     
     conn.commit()
 
-def process_and_store_layers(layers_json_path):
-    with open(layers_json_path, 'r') as file:
-        layers_data = json.load(file)
+def download_layer(layer):
+    from arcgis.features import FeatureLayer
+    from feature_download import OUT_SR, query_layer_features
+
+    layer_name = layer['title']
+    layer_url = layer['url']
+    
+    start = time.perf_counter()
+    feature_layer = FeatureLayer(layer_url)
+    with metrics.span('download'):
+        sdf = query_layer_features(feature_layer)
+    metrics.observe_host(layer_url, time.perf_counter() - start)
+    
+    # Features are always requested in OUT_SR, whatever the layer's own spatial reference is
+    srid = OUT_SR
+    try:
+        drawing_info = feature_layer.properties.drawingInfo
+    except (TypeError, KeyError):
+        logging.warning(f"Drawing info not available for layer: {layer_name}. Skipping.")
+        return None
+    
+    logging.info(f"Processing layer: {layer_name}")
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(sdf.head())
     
+    if sdf.empty:
+        logging.warning(f"No data found for layer: {layer_name}")
+        return None
+    
+    return sdf, srid, drawing_info, start
+
+def process_and_store_layers(layers_data):
     for layer in layers_data:
-        layer_name = layer['title']
-        layer_url = layer['url']
-        
-        feature_layer = FeatureLayer(layer_url)
-        sdf = feature_layer.query().sdf
-        
-        try:
-            srid = feature_layer.properties.extent['spatialReference']['latestWkid']
-            drawing_info = feature_layer.properties.drawingInfo
-        except (TypeError, KeyError):
-            logging.warning(f"Spatial reference or drawing info not available for layer: {layer_name}. Skipping.")
+        downloaded = download_layer(layer)
+        if downloaded is None:
             continue
         
-        logging.info(f"Processing layer: {layer_name}")
-        logging.info(sdf.head())
+        sdf, srid, drawing_info, start = downloaded
+        table_name = sanitize_table_name(layer['title'])
         
-        if sdf.empty:
-            logging.warning(f"No data found for layer: {layer_name}")
-            continue
-        
-        table_name = sanitize_table_name(layer_name)
-        
-        if not check_table_exists(table_name):
-            create_table_from_dataframe(table_name, sdf)
-        
-        insert_dataframe_to_supabase(table_name, sdf, srid, drawing_info)
+        with metrics.span('db_write'):
+            if not check_table_exists(table_name):
+                create_table_from_dataframe(table_name, sdf)
+            
+            mark_table_changed(table_name)
+            insert_dataframe_to_supabase(table_name, sdf, srid, drawing_info)
+        metrics.increment('layers_uploaded')
+        metrics.observe('layer', layer['title'], time.perf_counter() - start)
+
+async def process_and_store_layers_async(layers_data, writer, max_downloads=DOWNLOAD_CONCURRENCY):
+    """Downloads layers in worker threads and streams each one to the async writer as soon as it arrives,
+    so database writes overlap with the remaining downloads. At most max_downloads layers are downloaded
+    or written at once. Returns the titles of the layers that failed."""
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max_downloads)
+    
+    async def store_layer(layer):
+        # The slot is held until the layer is written, so downloads can't pile up faster than the writes drain them
+        async with semaphore:
+            downloaded = await loop.run_in_executor(None, download_layer, layer)
+            if downloaded is None:
+                return
+            
+            sdf, srid, drawing_info, start = downloaded
+            table_name = sanitize_table_name(layer['title'])
+            
+            with metrics.span('db_write'):
+                await writer.write(table_name, sdf, srid, drawing_info)
+        metrics.increment('layers_uploaded')
+        metrics.observe('layer', layer['title'], time.perf_counter() - start)
+    
+    results = await asyncio.gather(*(store_layer(layer) for layer in layers_data), return_exceptions=True)
+    failed_layers = []
+    for layer, result in zip(layers_data, results):
+        if isinstance(result, Exception):
+            metrics.increment('layer_errors')
+            logging.error(f"Error storing layer {layer['title']}: {result}")
+            failed_layers.append(layer['title'])
+    return failed_layers
+
+def load_layers(layers_json_path):
+    with open(layers_json_path, 'r') as file:
+        return json.load(file)
+
+async def store_layers_with_async_writer(layers_data):
+    from async_db_writer import AsyncDatabaseWriter
+    
+    writer = await AsyncDatabaseWriter.connect()
+    try:
+        return await process_and_store_layers_async(layers_data, writer)
+    finally:
+        await writer.close()
+
+async def store_layers_in_shadow_schema(layers_data):
+    """Loads every layer into a new versioned schema, indexes it and swaps it live atomically,
+    so readers never see empty or partially loaded tables. The swap only happens when every layer
+    and batch was written. Returns the titles of the layers that didn't go live: all of them when
+    the swap was skipped."""
+    from async_db_writer import AsyncDatabaseWriter
+    from shadow_schema import collect_garbage, create_shadow_schema, swap_schema
+    
+    writer = await AsyncDatabaseWriter.connect(deferred_unique=True)
+    try:
+        writer.schema = await create_shadow_schema(writer.pool)
+        failed_layers = await process_and_store_layers_async(layers_data, writer)
+        if failed_layers:
+            # The shadow schema lacks the failed layers' tables, swapping it in would drop them from the live schema
+            logging.error(f"{len(failed_layers)} layers failed, keeping the current live schema and dropping {writer.schema}")
+            return [layer['title'] for layer in layers_data]
+        if not writer.known_tables:
+            logging.warning("No layers were loaded, keeping the current live schema")
+            return []
+        if not await writer.build_unique_indexes():
+            logging.error(f"Not all unique indexes could be built, keeping the current live schema and dropping {writer.schema}")
+            return [layer['title'] for layer in layers_data]
+        await swap_schema(writer.pool, writer.schema)
+        return []
+    finally:
+        await collect_garbage(writer.pool)
+        await writer.close()
+
+def store_layers(layers_data):
+    """Uploads the layers and returns the titles of those that failed (the sync writer stops at the first failure)."""
+    global conn, cur
+    if DB_WRITER == 'async' and DB_LOAD_MODE == 'shadow':
+        return asyncio.run(store_layers_in_shadow_schema(layers_data))
+    elif DB_WRITER == 'async':
+        return asyncio.run(store_layers_with_async_writer(layers_data))
+    else:
+        conn = connect_to_database()
+        cur = conn.cursor()
+
+        process_and_store_layers(layers_data)
+
+        # Close the cursor and connection
+        cur.close()
+        conn.close()
+        return []
+
+def main():
+    parser = argparse.ArgumentParser(description="Download the layers in added_layers.json into the database")
+    parser.parse_args()
 
-# Example usage
-process_and_store_layers("added_layers.json")
+    logging.basicConfig(level=logging.INFO)
+    failed_layers = store_layers(load_layers("added_layers.json"))
+    if failed_layers:
+        logging.error(f"{len(failed_layers)} layers failed to upload: {', '.join(failed_layers)}")
+    metrics.write_report('upload_to_cockroachdb')
 
-# Close the cursor and connection
-cur.close()
-conn.close()
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 import os
 import psycopg2
 import json
+import logging
 import pandas as pd
 from arcgis.features import FeatureLayer
 import re
@@ -90,7 +91,7 @@ def insert_dataframe_to_database(table_name, dataframe, srid, drawing_info):
         VALUES ({values}) 
         ON CONFLICT (id) DO UPDATE SET {update_set}
         """
-        print(f"Inserting row with query: {insert_query}")
+        logging.debug("Inserting row with query: %s", insert_query)
         cur.execute(insert_query, tuple(row_dict.values()))
     
     conn.commit()
@@ -1,6 +1,7 @@
 import os
 import psycopg2
 import json
+import logging
 import pandas as pd
 import geopandas as gpd
 from arcgis.features import FeatureLayer
@@ -89,7 +90,7 @@ def insert_dataframe_to_supabase(table_name, dataframe, srid):
         VALUES ({values}) 
         ON CONFLICT (id) DO UPDATE SET {update_set}
         """
-        print(f"Inserting row with query: {insert_query}")  # Debug print
+        logging.debug("Inserting row with query: %s", insert_query)
         cur.execute(insert_query, tuple(row))
     
     conn.commit()
@@ -1,6 +1,7 @@
 import os
 import psycopg2
 import json
+import logging
 import pandas as pd
 import geopandas as gpd
 from arcgis.features import FeatureLayer
@@ -112,7 +113,7 @@ def insert_dataframe_to_supabase(cur, table_name, dataframe, metadata_id):
         VALUES ({values}) 
         ON CONFLICT (id) DO UPDATE SET {update_set}
         """
-        print(f"Inserting row with query: {insert_query}")  # Debug print
+        logging.debug("Inserting row with query: %s", insert_query)
         cur.execute(insert_query, tuple(row))
     
     cur.connection.commit()
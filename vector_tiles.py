@@ -0,0 +1,454 @@
+"""Exports the uploaded utility layers as a Mapbox Vector Tile pyramid in one MBTiles file.
+
+Every layer is simplified once per zoom level, clipped to the tiles it touches and encoded
+with mvt_encoder.py. The encoded tile of each layer is kept in a layer_tiles table inside the
+MBTiles file, so a later export only re-encodes layers whose rows changed and re-assembles
+the tiles those layers touch (before or after the change). The upload gives every table it
+writes a new version in layer_versions, and tables whose version is unchanged are not read at
+all; tables without a version are read and compared by their rows.
+
+    python vector_tiles.py                      # layers listed in added_layers.json
+    python vector_tiles.py --output tiles.mbtiles
+"""
+import os
+import gzip
+import json
+import math
+import sqlite3
+import asyncio
+import hashlib
+import logging
+import argparse
+from datetime import date, datetime
+import numpy as np
+from instrumentation import metrics
+from feature_download import AOI_BBOX
+from mvt_encoder import GEOMETRY_LINESTRING, GEOMETRY_POINT, encode_layer
+
+
+TILES_FILE_PATH = os.getenv('TILES_FILE_PATH', 'utility_layers.mbtiles')
+
+# Zoom levels of the pyramid, z10 covers the county in a handful of tiles
+MIN_ZOOM = int(os.getenv('TILE_MIN_ZOOM', '10'))
+MAX_ZOOM = int(os.getenv('TILE_MAX_ZOOM', '16'))
+
+# Tile coordinate grid and the margin kept around each tile so lines don't end at tile edges
+EXTENT = 4096
+BUFFER = 64
+
+# Simplification tolerance in tile units at every zoom (16 units are one pixel of a 256 px tile)
+SIMPLIFY_TOLERANCE = float(os.getenv('TILE_SIMPLIFY_TOLERANCE', '8'))
+
+# Attributes are only kept from this zoom on, lower zooms carry geometry only
+ATTRIBUTE_MIN_ZOOM = int(os.getenv('TILE_ATTRIBUTE_MIN_ZOOM', '14'))
+
+# Longer text attributes are cut to this many characters
+MAX_ATTRIBUTE_LENGTH = 256
+
+# Columns of the uploaded tables that never go into tiles
+EXCLUDED_COLUMNS = ['id', 'shape', 'srid', 'drawing_info', 'globalid']
+
+# Latitude limit of Web Mercator
+MAX_LATITUDE = 85.0511287798
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS tiles (
+    zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB,
+    PRIMARY KEY (zoom_level, tile_column, tile_row)
+);
+CREATE TABLE IF NOT EXISTS layer_tiles (
+    layer TEXT, zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB,
+    PRIMARY KEY (layer, zoom_level, tile_column, tile_row)
+);
+CREATE INDEX IF NOT EXISTS layer_tiles_tile ON layer_tiles (zoom_level, tile_column, tile_row);
+CREATE TABLE IF NOT EXISTS layer_state (layer TEXT PRIMARY KEY, fingerprint TEXT, fields TEXT);
+"""
+
+def tile_settings():
+    """Settings that change the encoded tiles, part of every layer fingerprint."""
+    return [MIN_ZOOM, MAX_ZOOM, EXTENT, BUFFER, SIMPLIFY_TOLERANCE, ATTRIBUTE_MIN_ZOOM, MAX_ATTRIBUTE_LENGTH, EXCLUDED_COLUMNS]
+
+def project(coordinates):
+    """Longitude/latitude to Web Mercator coordinates normalized to [0, 1], y pointing down."""
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    latitude = np.radians(np.clip(coordinates[:, 1], -MAX_LATITUDE, MAX_LATITUDE))
+    x = (coordinates[:, 0] + 180.0) / 360.0
+    y = 0.5 - np.log(np.tan(np.pi / 4 + latitude / 2)) / (2 * np.pi)
+    return np.column_stack([x, y])
+
+def aoi_tile_range(zoom):
+    """Column and row range of the tiles covering AOI_BBOX at a zoom level."""
+    (xmin, ymax), (xmax, ymin) = project([[AOI_BBOX[0], AOI_BBOX[1]], [AOI_BBOX[2], AOI_BBOX[3]]])
+    scale = 2 ** zoom
+    last = scale - 1
+    return (
+        min(int(xmin * scale), last), min(int(ymin * scale), last),
+        min(int(xmax * scale), last), min(int(ymax * scale), last)
+    )
+
+def parse_geometry(shape):
+    """Reads the GeoJSON stored in SHAPE into a tile geometry type and projected parts."""
+    if isinstance(shape, str):
+        shape = json.loads(shape)
+    if not shape or not shape.get('coordinates'):
+        return None
+    geometry_type = shape.get('type')
+    coordinates = shape['coordinates']
+    if geometry_type == 'Point':
+        return GEOMETRY_POINT, [project([coordinates])]
+    if geometry_type == 'MultiPoint':
+        return GEOMETRY_POINT, [project(coordinates)]
+    if geometry_type == 'LineString':
+        return GEOMETRY_LINESTRING, [project(coordinates)]
+    if geometry_type == 'MultiLineString':
+        return GEOMETRY_LINESTRING, [project(part) for part in coordinates if len(part) > 1]
+    # The pipeline only keeps point and line layers (see desired_geometry_types)
+    return None
+
+def simplify(points, tolerance):
+    """Douglas-Peucker simplification of a line given as an (n, 2) array."""
+    if len(points) < 3 or tolerance <= 0:
+        return points
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        a, b = points[start], points[end]
+        inner = points[start + 1:end]
+        dx, dy = b - a
+        length = math.hypot(dx, dy)
+        if length == 0:
+            distances = np.hypot(inner[:, 0] - a[0], inner[:, 1] - a[1])
+        else:
+            distances = np.abs(dx * (inner[:, 1] - a[1]) - dy * (inner[:, 0] - a[0])) / length
+        index = int(np.argmax(distances))
+        if distances[index] > tolerance:
+            split = start + 1 + index
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+    return points[keep]
+
+def drop_repeated_points(points):
+    if len(points) < 2:
+        return points
+    changed = np.any(points[1:] != points[:-1], axis=1)
+    return points[np.concatenate([[True], changed])]
+
+def clip_segment(x0, y0, x1, y1, xmin, ymin, xmax, ymax):
+    """Liang-Barsky clipping of one segment, returns the clipped end points or None."""
+    dx, dy = x1 - x0, y1 - y0
+    t0, t1 = 0.0, 1.0
+    for p, q in ((-dx, x0 - xmin), (dx, xmax - x0), (-dy, y0 - ymin), (dy, ymax - y0)):
+        if p == 0:
+            if q < 0:
+                return None
+            continue
+        t = q / p
+        if p < 0:
+            if t > t1:
+                return None
+            t0 = max(t0, t)
+        else:
+            if t < t0:
+                return None
+            t1 = min(t1, t)
+    return (x0 + t0 * dx, y0 + t0 * dy), (x0 + t1 * dx, y0 + t1 * dy)
+
+def clip_line(points, xmin, ymin, xmax, ymax):
+    """Splits a line into the pieces that fall inside the rectangle."""
+    if points[:, 0].min() >= xmin and points[:, 0].max() <= xmax and points[:, 1].min() >= ymin and points[:, 1].max() <= ymax:
+        return [points]
+    pieces = []
+    current = []
+    for (x0, y0), (x1, y1) in zip(points[:-1].tolist(), points[1:].tolist()):
+        clipped = clip_segment(x0, y0, x1, y1, xmin, ymin, xmax, ymax)
+        if clipped is None:
+            if current:
+                pieces.append(current)
+                current = []
+            continue
+        start, end = clipped
+        if current and current[-1] != start:
+            pieces.append(current)
+            current = []
+        if not current:
+            current = [start]
+        current.append(end)
+        if end != (x1, y1):
+            # The line leaves the rectangle here
+            pieces.append(current)
+            current = []
+    if current:
+        pieces.append(current)
+    return [np.array(piece) for piece in pieces]
+
+def trim_properties(row, columns):
+    properties = {}
+    for column in columns:
+        value = row[column]
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            continue
+        if isinstance(value, (datetime, date)):
+            value = value.isoformat()
+        elif isinstance(value, str):
+            value = value[:MAX_ATTRIBUTE_LENGTH]
+        properties[column] = value
+    return properties
+
+def field_type(value):
+    if isinstance(value, bool):
+        return 'Boolean'
+    if isinstance(value, (int, float)):
+        return 'Number'
+    return 'String'
+
+def build_layer_tiles(layer_name, rows):
+    """Encodes a layer into {(zoom, column, row): tile bytes} with rows in XYZ order."""
+    columns = [column for column in rows[0].keys() if column.lower() not in EXCLUDED_COLUMNS] if rows else []
+    features = []
+    for row in rows:
+        shape = next((row[column] for column in row.keys() if column.lower() == 'shape'), None)
+        geometry = parse_geometry(shape)
+        if geometry is None:
+            metrics.increment('tile_features_skipped')
+            continue
+        features.append((geometry, trim_properties(row, columns)))
+
+    tiles = {}
+    for zoom in range(MIN_ZOOM, MAX_ZOOM + 1):
+        scale = 2 ** zoom * EXTENT
+        min_column, min_row, max_column, max_row = aoi_tile_range(zoom)
+        with_attributes = zoom >= ATTRIBUTE_MIN_ZOOM
+        tile_features = {}
+        seen_points = set()
+        for (geometry_type, parts), properties in features:
+            if geometry_type == GEOMETRY_LINESTRING:
+                parts = [drop_repeated_points(np.round(simplify(part * scale, SIMPLIFY_TOLERANCE))) for part in parts]
+                parts = [part for part in parts if len(part) > 1]
+            else:
+                parts = [np.round(part * scale) for part in parts]
+            if not parts:
+                continue
+            stacked = np.concatenate(parts)
+            first_column = max(int((stacked[:, 0].min() - BUFFER) // EXTENT), min_column)
+            last_column = min(int((stacked[:, 0].max() + BUFFER) // EXTENT), max_column)
+            first_row = max(int((stacked[:, 1].min() - BUFFER) // EXTENT), min_row)
+            last_row = min(int((stacked[:, 1].max() + BUFFER) // EXTENT), max_row)
+            for column in range(first_column, last_column + 1):
+                for row in range(first_row, last_row + 1):
+                    origin = np.array([column * EXTENT, row * EXTENT])
+                    if geometry_type == GEOMETRY_LINESTRING:
+                        clipped = []
+                        for part in parts:
+                            for piece in clip_line(part - origin, -BUFFER, -BUFFER, EXTENT + BUFFER, EXTENT + BUFFER):
+                                piece = drop_repeated_points(np.round(piece))
+                                if len(piece) > 1:
+                                    clipped.append(piece.astype(np.int64).tolist())
+                    else:
+                        points = stacked - origin
+                        inside = np.all((points >= -BUFFER) & (points <= EXTENT + BUFFER), axis=1)
+                        points = [tuple(point) for point in points[inside].astype(np.int64).tolist()]
+                        if not with_attributes:
+                            # Without attributes, points landing on the same tile pixel are indistinguishable
+                            points = [point for point in points if (column, row, point) not in seen_points]
+                            seen_points.update((column, row, point) for point in points)
+                        clipped = [points] if points else []
+                    if clipped:
+                        tile_features.setdefault((column, row), []).append(
+                            (geometry_type, clipped, properties if with_attributes else {})
+                        )
+        for (column, row), encoded_features in tile_features.items():
+            tiles[(zoom, column, row)] = encode_layer(layer_name, encoded_features, EXTENT)
+
+    fields = {}
+    for _, properties in features:
+        for key, value in properties.items():
+            fields.setdefault(key, field_type(value))
+    return tiles, fields
+
+def layer_fingerprint(rows):
+    """Hash of a layer's rows, independent of the generated id and the row order."""
+    row_digests = sorted(
+        hashlib.sha256(json.dumps(
+            [value for key, value in row.items() if key != 'id'], default=str
+        ).encode('utf-8')).hexdigest()
+        for row in rows
+    )
+    return hashlib.sha256(json.dumps([tile_settings(), row_digests]).encode('utf-8')).hexdigest()
+
+def version_fingerprint(version):
+    """Fingerprint of a layer from the version the upload recorded, changes whenever the table is written."""
+    return hashlib.sha256(json.dumps([tile_settings(), 'version', version]).encode('utf-8')).hexdigest()
+
+def tms_row(zoom, row):
+    # MBTiles numbers rows from the bottom
+    return 2 ** zoom - 1 - row
+
+def open_mbtiles(path):
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+    return connection
+
+def layer_tile_keys(connection, layer_name):
+    return set(connection.execute(
+        "SELECT zoom_level, tile_column, tile_row FROM layer_tiles WHERE layer = ?", (layer_name,)
+    ))
+
+def replace_layer_tiles(connection, layer_name, tiles, fingerprint, fields):
+    """Swaps in a layer's new tiles and returns the keys of every tile it touched before or after."""
+    affected = layer_tile_keys(connection, layer_name)
+    connection.execute("DELETE FROM layer_tiles WHERE layer = ?", (layer_name,))
+    rows = [(layer_name, zoom, column, tms_row(zoom, row), data) for (zoom, column, row), data in tiles.items()]
+    connection.executemany("INSERT INTO layer_tiles VALUES (?, ?, ?, ?, ?)", rows)
+    connection.execute(
+        "INSERT OR REPLACE INTO layer_state VALUES (?, ?, ?)", (layer_name, fingerprint, json.dumps(fields))
+    )
+    affected.update((zoom, column, tile_row) for _, zoom, column, tile_row, _ in rows)
+    return affected
+
+def remove_layer(connection, layer_name):
+    affected = layer_tile_keys(connection, layer_name)
+    connection.execute("DELETE FROM layer_tiles WHERE layer = ?", (layer_name,))
+    connection.execute("DELETE FROM layer_state WHERE layer = ?", (layer_name,))
+    return affected
+
+def assemble_tiles(connection, tile_keys):
+    """Rebuilds the given tiles from the per-layer tiles; each tile is the concatenation of its layers."""
+    for zoom, column, row in sorted(tile_keys):
+        layers = connection.execute(
+            "SELECT tile_data FROM layer_tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ? ORDER BY layer",
+            (zoom, column, row)
+        ).fetchall()
+        if layers:
+            data = gzip.compress(b''.join(layer for layer, in layers))
+            connection.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)", (zoom, column, row, data))
+            metrics.increment('tiles_written')
+        else:
+            connection.execute(
+                "DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", (zoom, column, row)
+            )
+            metrics.increment('tiles_deleted')
+
+def write_metadata(connection, name):
+    vector_layers = [
+        {'id': layer, 'fields': json.loads(fields), 'minzoom': MIN_ZOOM, 'maxzoom': MAX_ZOOM}
+        for layer, fields in connection.execute("SELECT layer, fields FROM layer_state ORDER BY layer")
+    ]
+    center_zoom = min(max(MIN_ZOOM, 11), MAX_ZOOM)
+    metadata = {
+        'name': name,
+        'format': 'pbf',
+        'type': 'overlay',
+        'bounds': ','.join(str(value) for value in AOI_BBOX),
+        'center': f"{(AOI_BBOX[0] + AOI_BBOX[2]) / 2},{(AOI_BBOX[1] + AOI_BBOX[3]) / 2},{center_zoom}",
+        'minzoom': str(MIN_ZOOM),
+        'maxzoom': str(MAX_ZOOM),
+        'json': json.dumps({'vector_layers': vector_layers})
+    }
+    connection.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?)", metadata.items())
+
+async def table_exists(pool, table_name, schema=None):
+    return await pool.fetchval(
+        "SELECT EXISTS (SELECT 1 FROM information_schema.tables "
+        "WHERE table_name = $1 AND table_schema = COALESCE($2, current_schema()))",
+        table_name, schema
+    )
+
+async def fetch_layer_versions(pool, schema=None):
+    """Table name -> version recorded by the upload, empty for databases loaded before versions were kept."""
+    from upload_to_cockroachdb import VERSIONS_TABLE
+
+    if not await table_exists(pool, VERSIONS_TABLE, schema):
+        return {}
+    qualified_name = f'"{schema}".{VERSIONS_TABLE}' if schema else VERSIONS_TABLE
+    return {row['table_name']: row['version'] for row in await pool.fetch(f"SELECT table_name, version FROM {qualified_name}")}
+
+async def fetch_layer_rows(pool, table_name, schema=None):
+    qualified_name = f'"{schema}".{table_name}' if schema else table_name
+    if not await table_exists(pool, table_name, schema):
+        return None
+    return [dict(row) for row in await pool.fetch(f"SELECT * FROM {qualified_name}")]
+
+async def export_tiles(table_names, path=TILES_FILE_PATH, schema=None):
+    """Brings the MBTiles file at path up to date with the given tables.
+
+    Layers whose rows and tile settings are unchanged since the last export are not re-encoded,
+    and only the tiles touched by changed, new or removed layers are re-assembled. Tables whose
+    upload version is unchanged are not even read.
+    """
+    from async_db_writer import create_pool
+
+    pool = await create_pool()
+    connection = open_mbtiles(path)
+    try:
+        previous = dict(connection.execute("SELECT layer, fingerprint FROM layer_state"))
+        versions = await fetch_layer_versions(pool, schema)
+        affected = set()
+        for table_name in table_names:
+            version = versions.get(table_name)
+            if version is not None and previous.get(table_name) == version_fingerprint(version):
+                metrics.increment('tile_layers_unchanged')
+                continue
+            with metrics.span('tile_read'):
+                rows = await fetch_layer_rows(pool, table_name, schema)
+            if rows is None:
+                logging.warning(f"Table {table_name} not found, leaving it out of the tiles")
+                continue
+            fingerprint = version_fingerprint(version) if version is not None else layer_fingerprint(rows)
+            if previous.get(table_name) == fingerprint:
+                metrics.increment('tile_layers_unchanged')
+                continue
+            with metrics.span('tile_encode'):
+                loop = asyncio.get_running_loop()
+                tiles, fields = await loop.run_in_executor(None, build_layer_tiles, table_name, rows)
+            affected |= replace_layer_tiles(connection, table_name, tiles, fingerprint, fields)
+            metrics.increment('tile_layers_built')
+            logging.info(f"Encoded {len(tiles)} tiles for {table_name}")
+
+        for layer_name in set(previous) - set(table_names):
+            affected |= remove_layer(connection, layer_name)
+            logging.info(f"Removed {layer_name} from the tiles")
+
+        with metrics.span('tile_assemble'):
+            assemble_tiles(connection, affected)
+        write_metadata(connection, os.path.splitext(os.path.basename(path))[0])
+        connection.commit()
+        logging.info(f"Updated {len(affected)} tiles in {path}")
+    finally:
+        connection.close()
+        await pool.close()
+
+def layer_table_names(layers_data):
+    from upload_to_cockroachdb import sanitize_table_name
+
+    return list(dict.fromkeys(sanitize_table_name(layer['title']) for layer in layers_data))
+
+def export_schema():
+    """Schema the upload writes to: the live schema for shadow loads, else the search path."""
+    from upload_to_cockroachdb import DB_LOAD_MODE
+
+    if DB_LOAD_MODE == 'shadow':
+        from shadow_schema import LIVE_SCHEMA
+        return LIVE_SCHEMA
+    return None
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--layers', default='added_layers.json', help="Layer list written by search_relevant_layers.py")
+    parser.add_argument('--output', default=TILES_FILE_PATH)
+    args = parser.parse_args()
+
+    with open(args.layers, 'r') as f:
+        layers_data = json.load(f)
+    with metrics.span('export_tiles'):
+        asyncio.run(export_tiles(layer_table_names(layers_data), args.output, export_schema()))
+    metrics.write_report('vector_tiles')
+
+if __name__ == '__main__':
+    main()